@@ -1,28 +1,60 @@
-from threading import Thread
-import webapp
+import time
+startup_started = time.perf_counter()
+
 import discord
 from discord.ext import commands
 import logging
+import webapp
 from utils.db import Database
 from Variables.sensitiveVars import SensitiveVariables
 from cogs.flag_scanner import FlagScanner
 from cogs.leaderboard import Leaderboard
 from cogs.inactive_users import InactiveUsers
-import atexit
+from cogs.message_ingest import MessageIngest
+from cogs.member_sync import MemberSync
+from cogs.maintenance import Maintenance
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Heavy dependencies (pandas, matplotlib, paramiko) are imported by the commands that
+# use them; run with `python -X importtime src/bot.py` to see what import time remains.
+logger.info(f'Imports done in {time.perf_counter() - startup_started:.2f}s')
+
 # Initialize sensitive variables
 sensitive_vars = SensitiveVariables()
 
 # Initialize the database
+phase_started = time.perf_counter()
 Database().initialize_db()
+logger.info(f'Database ready in {time.perf_counter() - phase_started:.2f}s')
 
 intents = discord.Intents.all()
 intents.message_content = True
-bot = commands.Bot(command_prefix=',', intents=intents)
+
+class ActivityBot(commands.Bot):
+    """Bot that also serves the web dashboard on its own event loop."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.web_runner = None
+
+    async def setup_hook(self):
+        phase_started = time.perf_counter()
+        await load_cogs()
+        logger.info(f'Starting web server on port {webapp.WEB_PORT}')
+        self.web_runner = await webapp.start_web_server(webapp.WEB_PORT)
+        logger.info(f'Cogs and web server ready in {time.perf_counter() - phase_started:.2f}s')
+
+    async def close(self):
+        if self.web_runner is not None:
+            logger.info('Stopping web server')
+            await webapp.stop_web_server(self.web_runner)
+            self.web_runner = None
+        await super().close()
+
+bot = ActivityBot(command_prefix=',', intents=intents)
 
 logger.info('Starting bot')
 
@@ -31,25 +63,16 @@ async def load_cogs():
     await bot.add_cog(FlagScanner(bot))
     await bot.add_cog(Leaderboard(bot))
     await bot.add_cog(InactiveUsers(bot))
+    await bot.add_cog(MessageIngest(bot))
+    await bot.add_cog(MemberSync(bot))
+    await bot.add_cog(Maintenance(bot))
 
 @bot.event
 async def on_ready():
-    await load_cogs()
-    logger.info('Bot is ready')
-
-def stop_flask_server():
-    logger.info('Stopping Flask web server')
-    # Assuming webapp.app has a method to stop the server
-    webapp.app.shutdown()
-
-# Register the stop_flask_server function to be called on exit
-atexit.register(stop_flask_server)
-
-# Start the Flask web server in a separate thread
-logger.info('Starting Flask web server on port 8000')
-flask_thread = Thread(target=webapp.app.run, kwargs={'port':8000, 'debug': False, 'use_reloader': False})
-flask_thread.start()
+    # Cogs are loaded once in setup_hook; on_ready fires again after every reconnect
+    logger.info(f'Bot is ready, {time.perf_counter() - startup_started:.2f}s after start')
 
-logger.info('Running bot')
-bot.run(sensitive_vars.bot_token)
-logger.info('Bot has stopped')
+if __name__ == '__main__':
+    logger.info('Running bot')
+    bot.run(sensitive_vars.bot_token)
+    logger.info('Bot has stopped')
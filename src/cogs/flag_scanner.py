@@ -1,107 +1,86 @@
-import pandas as pd
+import asyncio
 import datetime
+import io
+import multiprocessing
 import discord
 from discord.ext import commands
 import logging
-import pytz
-from utils.db import Database
-from flags import Flag
+from utils.db import get_async_database, notify_scores_changed
+from flags import Flag, FLAG_NAMES, compute_flags
 
-import matplotlib.pyplot as plt
-import seaborn as sns
 import re
-from utils.score_calculator import calculate_score  # added import for shared score calculation
-
-database = Database()
-database.initialize_db()
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from utils.score_calculator import calculate_score, calculate_scores  # shared score calculation
+from utils.table_image import render_table
+from utils.timeutil import DAY_MS, now_ms
+from utils.score_cache import get_score_cache
+from utils.user_scores import score_user
 
 logger = logging.getLogger(__name__)
 
-today = pd.Timestamp.now(tz=pytz.utc)
-
-def dataframe_to_image(df, filename="table.png"):
-    fig, ax = plt.subplots(figsize=(len(df.columns) * 1.5, len(df) * 0.5))
-    ax.axis('tight')
-    ax.axis('off')
-    table = ax.table(cellText=df.values, colLabels=df.columns, cellLoc="center", loc="center")
-    table.auto_set_font_size(False)
-    table.set_fontsize(10)
-    table.auto_set_column_width(col=list(range(len(df.columns))))  # Adjust column width
-    plt.savefig(filename, bbox_inches='tight')
-    plt.close()
+# Rendered ,checkscore tables kept in memory, keyed by the user's score/flag snapshot
+RENDER_CACHE_SIZE = 256
+RENDER_WORKERS = 2
 
 class FlagScanner(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.df = pd.DataFrame(columns=["user_id", "last_message", "messages_past_month", "days_since_last_message", "final_score"])
+        # Filled by the first rescan; pandas is only imported then
+        self.df = None
         logger.info("FlagScanner cog initialized")
         self.flag = Flag(bot)
-        self.db = Database()
+        self.db = get_async_database()
+        self.score_cache = get_score_cache()
+        self._render_pool = None
+        self._render_cache = OrderedDict()
+
+    def cog_unload(self):
+        if self._render_pool is not None:
+            self._render_pool.shutdown(wait=False, cancel_futures=True)
 
     async def _initialize_dataframe(self):
-        """Initialize the DataFrame with user data and calculate initial scores from the database."""
+        """Rescan every user in bulk: build the feature frame from one aggregate query, score it and write all scores back at once."""
+        import pandas as pd
+
         logger.info("Initializing DataFrame with user data from the database")
-        user_data = []
-        with database.get_db_connection() as conn:
-            result = conn.execute('''
-                SELECT DISTINCT user_id FROM messages
-            ''').fetchall()
-        
-        for row in result:
-            user_id = row['user_id']
-            logger.info(f"Fetching data for user: {user_id}")
-            last_message = await self._get_last_message_time(user_id)
-            messages_past_month = await self._get_messages_past_month(user_id)
-            flags = await self.flag.get_user_activity_flags(user_id)
-            user_data.append({
+        stats = await self.flag.get_activity_stats()
+        user_data = [
+            {
                 "user_id": user_id,
-                "last_message": last_message,
-                "messages_past_month": messages_past_month,
-                **flags
-            })
-        
-        df = pd.DataFrame(user_data)
-        df["last_message"] = pd.to_datetime(df["last_message"])
-        df["last_message"] = df["last_message"].dt.tz_localize('UTC', ambiguous='NaT') if df["last_message"].dt.tz is None else df["last_message"]
-        df["days_since_last_message"] = (today - df["last_message"]).dt.days
-        logger.info(f"Calculating score for user {row['user_id']}")
-        df["final_score"] = df.apply(self._calculate_score, axis=1)
-        logger.info(f"Calculated scores: {df[['user_id', 'final_score']]}")
+                "last_message": user_stats["last_message"],
+                "messages_past_month": user_stats["recent_count"],
+                **compute_flags(user_stats)
+            }
+            for user_id, user_stats in stats.items()
+        ]
+
+        df = pd.DataFrame(user_data, columns=["user_id", "last_message", "messages_past_month", *FLAG_NAMES])
+        df = df.astype({name: bool for name in FLAG_NAMES})
+        # Index by user ID so get_user_data is a hash lookup instead of a scan
+        df.index = df["user_id"]
+        # Timestamps are epoch milliseconds, so the recency is plain integer arithmetic
+        df["days_since_last_message"] = (now_ms() - df["last_message"]) // DAY_MS
+        logger.info(f"Calculating scores for {len(df)} users")
+        df["final_score"] = calculate_scores(df)
         self.df = df
+        self.score_cache.invalidate()
         logger.info("DataFrame initialization complete")
-        logger.info(f"DataFrame content: {self.df}")
-
-        # Update the final scores in the database
-        for _, row in df.iterrows():
-            logger.info(f"Updating final score for user {row['user_id']} to {row['final_score']}")
-            database.update_final_score(row['user_id'], row['final_score'])
-
-    async def _get_last_message_time(self, user_id):
-        """Fetch the last message time for a user from the database."""
-        logger.info(f"Fetching last message time for user: {user_id}")
-        with database.get_db_connection() as conn:
-            result = conn.execute('''
-                SELECT created_at FROM messages
-                WHERE user_id = ?
-                ORDER BY created_at DESC
-                LIMIT 1
-            ''', (str(user_id),)).fetchone()
-        last_message = result['created_at'] if result else None
-        logger.info(f"Last message time for user {user_id}: {last_message}")
-        return last_message
-
-    async def _get_messages_past_month(self, user_id):
-        """Fetch the number of messages sent by a user in the past month from the database."""
-        logger.info(f"Fetching messages past month for user: {user_id}")
-        one_month_ago = datetime.datetime.now(pytz.utc) - datetime.timedelta(days=30)
-        with database.get_db_connection() as conn:
-            result = conn.execute('''
-                SELECT COUNT(*) as message_count FROM messages
-                WHERE user_id = ? AND created_at >= ?
-            ''', (str(user_id), one_month_ago)).fetchone()
-        count = result['message_count'] if result else 0
-        logger.info(f"Messages past month for user {user_id}: {count}")
-        return count
+
+        # Update the scores and stats in the database in a single transaction
+        await self.db.call('update_user_stats', [
+            {
+                "user_id": user_id,
+                "score": score,
+                "message_count": stats[user_id]["total_count"],
+                "messages_past_month": stats[user_id]["recent_count"],
+                "first_message": stats[user_id]["first_message"],
+                "last_message": stats[user_id]["last_message"]
+            }
+            for user_id, score in zip(df["user_id"], df["final_score"])
+        ])
+        logger.info(f"Updated final scores for {len(df)} users")
+        return df
 
     def _calculate_score(self, row):
         # Replace inline calculation with shared score calculation
@@ -110,36 +89,65 @@ class FlagScanner(commands.Cog):
     async def get_user_data(self, user_id):
         """Retrieve user data for a given user ID."""
         logger.info(f"Retrieving data for user ID: {user_id}")
-        user_row = self.df[self.df["user_id"] == user_id]
-        if not user_row.empty:
+        if self.df is None:
+            logger.info(f"No user data loaded yet for user ID: {user_id}")
+            return None
+        if str(user_id) in self.df.index:
             logger.info(f"User data found for user ID: {user_id}")
-            return user_row.iloc[0]
+            return self.df.loc[str(user_id)]
         logger.info(f"No user data found for user ID: {user_id}")
         return None
 
     async def calculate_score(self, user_id):
         """Calculate the score for a given user."""
-        # Fetch necessary data
-        last_message = await self._get_last_message_time(user_id)
-        messages_past_month = await self._get_messages_past_month(user_id)
-        flags = await self.flag.get_user_activity_flags(user_id)
-
-        # Create a DataFrame row for the user
-        user_row = {
-            "user_id": user_id,
-            "last_message": last_message,
-            "messages_past_month": messages_past_month,
-            **flags
-        }
-
-        # Calculate the score using the same logic as _calculate_score
-        score = self._calculate_score(user_row)
-
-        # Update the final score in the database
-        database.update_final_score(user_id, score)
-
+        return (await self._get_score_entry(user_id)).score
+
+    async def _get_score_entry(self, user_id):
+        """Return the user's cached score and flags, computing and caching them on a miss."""
+        entry = self.score_cache.get(user_id)
+        if entry is None:
+            # Not cached if the user is invalidated while the score is being computed
+            generation = self.score_cache.generation
+            score, flags = await self._score_user(user_id)
+            entry = self.score_cache.put(user_id, score, flags, generation)
+        return entry
+
+    async def _score_user(self, user_id):
+        """Calculate, store and return the score of a user together with their flags."""
+        # Same scoring path as the rescoring scheduler, so both write the same score
+        score, flags = await self.db.run(score_user, user_id)
+        notify_scores_changed()
         logger.info(f"Final score for user {user_id}: {score}")
-        return score
+        return score, flags
+
+    async def _render_score_table(self, user_id, score, flags):
+        """Render the score table as PNG bytes in a worker process, reusing the image if the snapshot is unchanged."""
+        key = (user_id, score, *(flags[name] for name in FLAG_NAMES))
+        image = self._render_cache.get(key)
+        if image is not None:
+            self._render_cache.move_to_end(key)
+            return image
+        if self._render_pool is None:
+            # Forking a process that already runs the database and to_thread workers is unsafe
+            self._render_pool = ProcessPoolExecutor(
+                max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context('spawn')
+            )
+        columns = ["user_id", "score", *FLAG_NAMES]
+        rows = [[str(value) for value in key]]
+        loop = asyncio.get_running_loop()
+        image = await loop.run_in_executor(self._render_pool, render_table, columns, rows)
+        self._render_cache[key] = image
+        if len(self._render_cache) > RENDER_CACHE_SIZE:
+            self._render_cache.popitem(last=False)
+        return image
+
+    @commands.command(name="rescan")
+    @commands.has_permissions(administrator=True)
+    async def rescan(self, ctx):
+        """Command to recalculate and store the scores of every user."""
+        start_time = datetime.datetime.now()
+        df = await self._initialize_dataframe()
+        await ctx.send(f"Rescanned {len(df)} users in {datetime.datetime.now() - start_time}.")
 
     @commands.command(name="checkscore")
     async def check_score(self, ctx, user_id: str = None):
@@ -160,30 +168,16 @@ class FlagScanner(commands.Cog):
             return
 
         start_time = datetime.datetime.now()
-        logger.info(f"Recalculating score for user ID: {user_id}")
-
-        # Recalculate the score dynamically using the new logic
-        score = await self.calculate_score(user_id)
-        logger.info(f"Dynamic score for user {user_id}: {score}")
-
-        # Create a DataFrame for the user score
-        user_score_df = pd.DataFrame({
-            "user_id": [user_id],
-            "score": [score],
-            "sent_messages_after_joining": [await self.flag.sent_messages_after_joining(user_id)],
-            "messaged_within_30_days": [await self.flag.messaged_within_x_days(user_id, 30)],
-            "above_100_messages": [await self.flag.above_x_messages(user_id, 100)],
-            "below_10_messages": [await self.flag.below_x_messages(user_id, 10)],
-            "never_messaged": [await self.flag.never_messaged(user_id)],
-            "no_role_assigned": [await self.flag.no_role_assigned(user_id)],
-            "low_interaction_high_activity": [await self.flag.low_interaction_high_activity(user_id)]
-        })
-
-        # Convert the DataFrame to an image
-        dataframe_to_image(user_score_df, filename="user_score.png")
-
-        # Send the image
-        await ctx.send(file=discord.File("user_score.png"))
+        logger.info(f"Checking score for user ID: {user_id}")
+
+        # Served from the score cache unless the user's activity or links changed since the last lookup
+        entry = await self._get_score_entry(user_id)
+        score, flags = entry.score, entry.flags
+        logger.info(f"Score for user {user_id}: {score} (score cache: {self.score_cache.stats()})")
+
+        # Render the table off the event loop and send it straight from memory
+        image = await self._render_score_table(user_id, score, flags)
+        await ctx.send(file=discord.File(io.BytesIO(image), filename="user_score.png"))
 
         end_time = datetime.datetime.now()
         logger.info(f"Score recalculation completed in {end_time - start_time}")
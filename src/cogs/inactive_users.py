@@ -1,6 +1,6 @@
 import discord
 from discord.ext import commands
-from utils.get_inactive_users import UserActivity
+from utils.get_inactive_users import UserActivity, INACTIVE_DAYS
 
 
 class InactiveUsers(commands.Cog):
@@ -9,14 +9,16 @@ class InactiveUsers(commands.Cog):
         self.user_activity = UserActivity(bot=bot)
 
     @commands.command(name='inactive_users')
-    async def fetch_inactive_users(self, ctx):
-        inactive_users = await self.user_activity.get_inactive_users()
+    async def fetch_inactive_users(self, ctx, days: int = INACTIVE_DAYS):
+        counts = await self.user_activity.get_inactivity_counts(days)
         active_users = await self.user_activity.get_active_user_count()
-        if not inactive_users:
+        if not counts['inactive']:
             await ctx.send('No inactive users found.')
         else:
-            user_list = ', '.join([str(user) for user in inactive_users])
-            await ctx.send(f'Number of inactive users: {len(inactive_users)}')
+            await ctx.send(
+                f"Number of inactive users: {counts['inactive']} of {counts['members']} members "
+                f"({counts['unlinked']} not linked, {counts['no_recent_messages']} without messages in {days} days)"
+            )
             await ctx.send(f'active users: {active_users}')
 
 async def setup(bot):
@@ -1,43 +1,44 @@
+import asyncio
 import discord
 from discord.ext import commands
-import aiohttp
 import logging
-import pandas as pd  # Added import for pandas
+from utils.leaderboard import get_leaderboard_service
 
 logger = logging.getLogger(__name__)
 
-# New function to provide leaderboard data for the webapp
-
-def get_leaderboard():
-    data = {
-        "username": ["User1", "User2", "User3"],
-        "score": [100, 200, 150]
-    }
-    return pd.DataFrame(data)
+# Most entries shown in one leaderboard embed
+MAX_EMBED_ENTRIES = 25
 
 
 class Leaderboard(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        # Updated endpoint to point to the Flask server running on port 8000
-        self.endpoint = r'http://localhost:8000/leaderboard'
+        # Same ranking service the web app serves from
+        self.service = get_leaderboard_service()
 
     @commands.command(name='leaderboard')
     async def leaderboard(self, ctx, limit: int = 10):
         """Get the leaderboard of top users."""
-        async with aiohttp.ClientSession() as session:
-            try:
-                params = {'limit': limit}
-                async with session.get(self.endpoint, params=params) as resp:
-                    if resp.status == 200:
-                        data = await resp.text()
-                        await ctx.send(f'Leaderboard:\n```{data}```')
-                    else:
-                        await ctx.send('Could not fetch leaderboard data.')
-            except Exception as e:
-                logger.error(f'Error fetching leaderboard: {e}')
-                await ctx.send('Error fetching leaderboard.')
-
-
-def setup(bot):
-    bot.add_cog(Leaderboard(bot))
+        limit = min(max(limit, 1), MAX_EMBED_ENTRIES)
+        try:
+            # A rebuild queries the database, so keep it off the event loop
+            entries, ranking = await asyncio.to_thread(self.service.top, limit)
+        except Exception as e:
+            logger.error(f'Error fetching leaderboard: {e}')
+            await ctx.send('Error fetching leaderboard.')
+            return
+        if not entries:
+            await ctx.send('No leaderboard data yet.')
+            return
+
+        embed = discord.Embed(title='Leaderboard', color=discord.Color.blue(), timestamp=ranking.last_modified)
+        embed.description = '\n'.join(
+            f'`#{rank}` **{discord.utils.escape_markdown(username)}** — {score:g}'
+            for rank, (_, username, score) in enumerate(entries, start=1)
+        )
+        embed.set_footer(text=f'Top {len(entries)} of {len(ranking.entries)} users')
+        await ctx.send(embed=embed)
+
+
+async def setup(bot):
+    await bot.add_cog(Leaderboard(bot))
@@ -0,0 +1,93 @@
+from discord.ext import commands, tasks
+import logging
+from utils.db import get_async_database, notify_scores_changed
+from utils.retention import enable_incremental_vacuum, run_retention, RETENTION_INTERVAL_HOURS, RETENTION_MODE
+from utils.user_scores import (
+    rescore_dirty_users, rescore_user_page,
+    RESCORE_BATCH_SIZE, RESCORE_INTERVAL_SECONDS, DECAY_INTERVAL_HOURS
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Maintenance(commands.Cog):
+    """
+    Periodic database upkeep: rescores users whose activity or links changed, rescores
+    everyone once a day for recency decay, compacts old message content and vacuums
+    freed pages.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.db = get_async_database()
+
+    async def cog_load(self):
+        self.rescore_loop.start()
+        self.decay_loop.start()
+        if RETENTION_MODE != 'off':
+            self.retention_loop.start()
+
+    async def cog_unload(self):
+        self.rescore_loop.cancel()
+        self.decay_loop.cancel()
+        self.retention_loop.cancel()
+
+    @tasks.loop(seconds=RESCORE_INTERVAL_SECONDS)
+    async def rescore_loop(self):
+        # Drain the dirty queue one batch per transaction so ingestion can interleave
+        rescored = 0
+        try:
+            while True:
+                scores = await self.db.run(rescore_dirty_users, RESCORE_BATCH_SIZE)
+                rescored += len(scores)
+                if scores:
+                    notify_scores_changed()
+                if len(scores) < RESCORE_BATCH_SIZE:
+                    break
+        except Exception as e:
+            logger.error(f"Dirty user rescore failed: {e}")
+        if rescored:
+            logger.info(f"Rescored {rescored} changed users")
+
+    @tasks.loop(hours=DECAY_INTERVAL_HOURS)
+    async def decay_loop(self):
+        # Scores only depend on user_stats and the daily buckets, so this never scans messages
+        rescored = 0
+        after_user_id = ''
+        try:
+            while True:
+                scores = await self.db.run(rescore_user_page, after_user_id, RESCORE_BATCH_SIZE)
+                rescored += len(scores)
+                if scores:
+                    notify_scores_changed()
+                if len(scores) < RESCORE_BATCH_SIZE:
+                    break
+                after_user_id = max(scores)
+        except Exception as e:
+            logger.error(f"Decay rescore failed: {e}")
+        logger.info(f"Decay pass rescored {rescored} users")
+
+    @tasks.loop(hours=RETENTION_INTERVAL_HOURS)
+    async def retention_loop(self):
+        try:
+            await run_retention(self.db)
+        except Exception as e:
+            logger.error(f"Retention job failed: {e}")
+
+    @commands.command(name="enable_vacuum")
+    @commands.has_permissions(administrator=True)
+    async def enable_vacuum(self, ctx):
+        """Switch the database to incremental auto-vacuum; runs a one-off full VACUUM that blocks the bot's queries."""
+        await ctx.send("Running a full VACUUM, database queries wait until it finishes...")
+        vacuumed = await self.db.run_outside_transaction(enable_incremental_vacuum)
+        await ctx.send("Incremental auto-vacuum enabled." if vacuumed else "Incremental auto-vacuum was already enabled.")
+
+    @rescore_loop.before_loop
+    @decay_loop.before_loop
+    @retention_loop.before_loop
+    async def before_loop(self):
+        await self.bot.wait_until_ready()
+
+
+async def setup(bot):
+    await bot.add_cog(Maintenance(bot))
@@ -0,0 +1,54 @@
+from discord.ext import commands
+import logging
+from utils.db import get_async_database
+from utils.get_inactive_users import sync_guild_members, upsert_members, remove_member, remove_guild
+
+logger = logging.getLogger(__name__)
+
+
+def member_row(member):
+    return (member.id, member.name, member.joined_at)
+
+
+class MemberSync(commands.Cog):
+    """Keeps the members table in sync with the guilds' member lists from gateway events."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.db = get_async_database()
+
+    async def sync_guild(self, guild):
+        members = [member_row(member) for member in guild.members]
+        await self.db.run(sync_guild_members, guild.id, members)
+        logger.info(f"Synced {len(members)} members of guild {guild.name}")
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # Full resync on (re)connect, since member events may have been missed while offline
+        for guild in self.bot.guilds:
+            await self.sync_guild(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        await self.sync_guild(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        await self.db.run(remove_guild, guild.id)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        await self.db.run(upsert_members, member.guild.id, [member_row(member)])
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        if before.name != after.name:
+            await self.db.run(upsert_members, after.guild.id, [member_row(after)])
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        await self.db.run(remove_member, member.guild.id, member.id)
+
+
+async def setup(bot):
+    await bot.add_cog(MemberSync(bot))
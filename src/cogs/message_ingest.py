@@ -0,0 +1,31 @@
+from discord.ext import commands
+import logging
+from utils.ingest import MessageIngestor
+
+logger = logging.getLogger(__name__)
+
+
+class MessageIngest(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.ingestor = MessageIngestor()
+
+    async def cog_load(self):
+        self.ingestor.start()
+        logger.info("Live message ingestion started")
+
+    async def cog_unload(self):
+        # Flush queued messages before the bot shuts down
+        await self.ingestor.close()
+        logger.info("Live message ingestion stopped")
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        # Only guild messages with content are stored, like the history backfill
+        if message.guild is None or not message.content:
+            return
+        await self.ingestor.submit(message)
+
+
+async def setup(bot):
+    await bot.add_cog(MessageIngest(bot))
@@ -1,69 +1,151 @@
 from discord.ext import commands
 import datetime
 import pytz
-from utils.db import Database
+from utils.db import QUERY_CHUNK_SIZE, get_async_database
+from utils.activity_daily import day_key
+from utils.timeutil import days_ago_ms, to_epoch_ms
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Order of the flags in a user's flag vector
+FLAG_NAMES = (
+    "sent_messages_after_joining",
+    "messaged_within_30_days",
+    "above_100_messages",
+    "below_10_messages",
+    "never_messaged",
+    "no_role_assigned",
+    "low_interaction_high_activity"
+)
+
+
+def empty_stats():
+    """Return the activity stats of a user with no messages."""
+    return {
+        "total_count": 0,
+        "since_join_count": 0,
+        "recent_count": 0,
+        "first_message": None,
+        "last_message": None
+    }
+
+
+def compute_flags(stats):
+    """Build the flag vector for a user from their activity stats."""
+    high_activity_threshold = 100
+    low_interaction_threshold = 10
+    total_count = stats["total_count"]
+    return {
+        "sent_messages_after_joining": stats["since_join_count"] > 0,
+        "messaged_within_30_days": stats["recent_count"] > 0,
+        "above_100_messages": total_count > 100,
+        "below_10_messages": total_count < 10,
+        "never_messaged": total_count == 0,
+        "no_role_assigned": False,  # Placeholder until roles are tracked
+        "low_interaction_high_activity": total_count > high_activity_threshold and total_count < low_interaction_threshold
+    }
+
+
+def query_activity_stats(conn, user_ids, joined_at, since):
+    """
+    Run the grouped activity query behind Flag.get_activity_stats on an open connection.
+    Counts are summed from the activity_daily buckets, so windows have UTC-day granularity.
+    """
+    join_days = {str(user_id): day_key(to_epoch_ms(value)) for user_id, value in (joined_at or {}).items() if value is not None}
+    stats = {}
+    if user_ids is None:
+        rows = conn.execute('''
+            SELECT a.user_id,
+                   SUM(a.message_count) AS total_count,
+                   SUM(a.message_count) AS since_join_count,
+                   SUM(CASE WHEN a.day >= ? THEN a.message_count ELSE 0 END) AS recent_count,
+                   MIN(a.first_message) AS first_message,
+                   MAX(a.last_message) AS last_message
+            FROM activity_daily a
+            GROUP BY a.user_id
+        ''', (day_key(since),)).fetchall()
+    else:
+        user_ids = list(dict.fromkeys(str(user_id) for user_id in user_ids))
+        rows = []
+        for start in range(0, len(user_ids), QUERY_CHUNK_SIZE):
+            chunk = user_ids[start:start + QUERY_CHUNK_SIZE]
+            targets = ', '.join('(?, ?)' for _ in chunk)
+            params = [value for user_id in chunk for value in (user_id, join_days.get(user_id))]
+            rows.extend(conn.execute(f'''
+                WITH targets(user_id, join_day) AS (VALUES {targets})
+                SELECT a.user_id,
+                       SUM(a.message_count) AS total_count,
+                       SUM(CASE WHEN t.join_day IS NULL OR a.day >= t.join_day THEN a.message_count ELSE 0 END) AS since_join_count,
+                       SUM(CASE WHEN a.day >= ? THEN a.message_count ELSE 0 END) AS recent_count,
+                       MIN(a.first_message) AS first_message,
+                       MAX(a.last_message) AS last_message
+                FROM targets t
+                JOIN activity_daily a ON a.user_id = t.user_id
+                GROUP BY a.user_id
+            ''', (*params, day_key(since))).fetchall())
+        stats = {user_id: empty_stats() for user_id in user_ids}
+    for row in rows:
+        stats[row['user_id']] = {
+            "total_count": row['total_count'],
+            "since_join_count": row['since_join_count'] or 0,
+            "recent_count": row['recent_count'] or 0,
+            "first_message": row['first_message'],
+            "last_message": row['last_message']
+        }
+    return stats
+
+
 class Flag(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.database = Database()
-        self.today = datetime.datetime.now(pytz.utc)
+        self.database = get_async_database()
+
+    @property
+    def today(self):
+        return datetime.datetime.now(pytz.utc)
+
+    async def get_activity_stats(self, user_ids=None, joined_at=None, days=30):
+        """
+        Compute the activity stats of many users in one grouped pass over the daily buckets.
+        `user_ids` limits the scan to the given users (all users when None) and
+        `joined_at` optionally maps a user ID to the time they joined. Returns a
+        dict keyed by user ID (as stored, i.e. str) with the total message count,
+        the count since joining, the count in the last `days` days and the first/last
+        message timestamps.
+        """
+        x_days_ago = days_ago_ms(days)
+        return await self.database.run(query_activity_stats, user_ids, joined_at, x_days_ago)
+
+    async def _get_user_stats(self, user_id, joined_at=None, days=30):
+        joined_at = {user_id: joined_at} if joined_at is not None else None
+        stats = await self.get_activity_stats([user_id], joined_at, days)
+        return stats[str(user_id)]
 
     async def sent_messages_after_joining(self, user_id, joined_at=None):
         # Check if the user has sent messages after joining
-        if joined_at is None:
-            with self.database.get_db_connection() as conn:
-                result = conn.execute('''
-                    SELECT MIN(created_at) as joined_at FROM messages
-                    WHERE user_id = ?
-                ''', (str(user_id),)).fetchone()
-            joined_at = result['joined_at'] if result else self.today
-        with self.database.get_db_connection() as conn:
-            result = conn.execute('''
-                SELECT COUNT(*) as message_count FROM messages
-                WHERE user_id = ? AND created_at >= ?
-            ''', (str(user_id), joined_at)).fetchone()
-        return result['message_count'] > 0 if result else False
+        stats = await self._get_user_stats(user_id, joined_at)
+        return stats["since_join_count"] > 0
 
     async def messaged_within_x_days(self, user_id, days):
         # Check if the user has messaged within the specified number of days
-        x_days_ago = self.today - datetime.timedelta(days=days)
-        with self.database.get_db_connection() as conn:
-            result = conn.execute('''
-                SELECT COUNT(*) as message_count FROM messages
-                WHERE user_id = ? AND created_at >= ?
-            ''', (str(user_id), x_days_ago)).fetchone()
-        return result['message_count'] > 0 if result else False
+        stats = await self._get_user_stats(user_id, days=days)
+        return stats["recent_count"] > 0
 
     async def above_x_messages(self, user_id, count):
         # Check if the user has sent more than the specified number of messages
-        with self.database.get_db_connection() as conn:
-            result = conn.execute('''
-                SELECT COUNT(*) as message_count FROM messages
-                WHERE user_id = ?
-            ''', (str(user_id),)).fetchone()
-        return result['message_count'] > count if result else False
+        stats = await self._get_user_stats(user_id)
+        return stats["total_count"] > count
 
     async def below_x_messages(self, user_id, count):
         # Check if the user has sent fewer than the specified number of messages
-        with self.database.get_db_connection() as conn:
-            result = conn.execute('''
-                SELECT COUNT(*) as message_count FROM messages
-                WHERE user_id = ?
-            ''', (str(user_id),)).fetchone()
-        return result['message_count'] < count if result else False
+        stats = await self._get_user_stats(user_id)
+        return stats["total_count"] < count
 
     async def never_messaged(self, user_id):
         # Check if the user has never sent a message
-        with self.database.get_db_connection() as conn:
-            result = conn.execute('''
-                SELECT COUNT(*) as message_count FROM messages
-                WHERE user_id = ?
-            ''', (str(user_id),)).fetchone()
-        return result['message_count'] == 0 if result else True
+        stats = await self._get_user_stats(user_id)
+        return stats["total_count"] == 0
 
     async def no_role_assigned(self, user_id):
         # Check if the user has no role assigned
@@ -72,26 +154,12 @@ class Flag(commands.Cog):
 
     async def low_interaction_high_activity(self, user_id):
         # Check if the user has low interaction but high activity
-        high_activity_threshold = 100
-        low_interaction_threshold = 10
-        with self.database.get_db_connection() as conn:
-            result = conn.execute('''
-                SELECT COUNT(*) as message_count FROM messages
-                WHERE user_id = ?
-            ''', (str(user_id),)).fetchone()
-        message_count = result['message_count'] if result else 0
-        return message_count > high_activity_threshold and message_count < low_interaction_threshold
+        stats = await self._get_user_stats(user_id)
+        return compute_flags(stats)["low_interaction_high_activity"]
 
     async def get_user_activity_flags(self, user_id, joined_at=None):
-        # Combine all flags into one method
-        flags = {
-            "sent_messages_after_joining": await self.sent_messages_after_joining(user_id, joined_at),
-            "messaged_within_30_days": await self.messaged_within_x_days(user_id, 30),
-            "above_100_messages": await self.above_x_messages(user_id, 100),
-            "below_10_messages": await self.below_x_messages(user_id, 10),
-            "never_messaged": await self.never_messaged(user_id),
-            "no_role_assigned": await self.no_role_assigned(user_id),
-            "low_interaction_high_activity": await self.low_interaction_high_activity(user_id)
-        }
+        # Combine all flags into one method, computed from a single grouped query
+        stats = await self._get_user_stats(user_id, joined_at)
+        flags = compute_flags(stats)
         logger.info(f"Flags for user {user_id}: {flags}")
-        return flags
\ No newline at end of file
+        return flags
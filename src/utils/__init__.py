@@ -1,4 +1,20 @@
 # Initialize the utils package
-from .db import Database
-from .get_linked_users import LinkedUsers
-from .get_inactive_users import UserActivity
\ No newline at end of file
+# Exports are resolved on first access, so importing one helper (e.g. utils.db) does not
+# also pull in the heavy dependencies of the others (paramiko, pandas).
+import importlib
+
+_exports = {
+    "Database": ".db",
+    "AsyncDatabase": ".db",
+    "get_async_database": ".db",
+    "LinkedUsers": ".get_linked_users",
+    "UserActivity": ".get_inactive_users",
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    if name in _exports:
+        return getattr(importlib.import_module(_exports[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,34 @@
+from utils.timeutil import days_ago_ms, from_epoch_ms
+
+
+def day_key(value):
+    """Return the UTC day bucket ('YYYY-MM-DD') of a timestamp in epoch milliseconds."""
+    return from_epoch_ms(value).strftime('%Y-%m-%d')
+
+
+def day_cutoff(days, now=None):
+    """Return the first day bucket inside a window of `days` days ending `now` (epoch ms)."""
+    return day_key(days_ago_ms(days, now))
+
+
+def record_daily_activity(conn, rows):
+    """
+    Fold message rows of the form (message_id, user_id, username, channel_id, content,
+    created_at) into activity_daily. Runs inside the caller's transaction.
+    """
+    buckets = {}
+    for message_id, user_id, username, channel_id, content, created_at in rows:
+        key = (user_id, day_key(created_at), channel_id or '')
+        entry = buckets.setdefault(key, [0, created_at, created_at])
+        entry[0] += 1
+        entry[1] = min(entry[1], created_at)
+        entry[2] = max(entry[2], created_at)
+    conn.executemany('''
+        INSERT INTO activity_daily (user_id, day, channel_id, message_count, first_message, last_message)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, day, channel_id) DO UPDATE SET
+            message_count = message_count + excluded.message_count,
+            first_message = MIN(first_message, excluded.first_message),
+            last_message = MAX(last_message, excluded.last_message)
+    ''', ((*key, *entry) for key, entry in buckets.items()))
+    return buckets
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from collections import Counter
+import discord
+
+logger = logging.getLogger(__name__)
+
+
+class ChannelCrawler:
+    """
+    Crawls channels with a bounded pool of workers. Channels are handed out in priority
+    order (lowest key first), at most `per_guild_limit` at a time per guild. Rate limit
+    errors halve the number of channels crawled at once and requeue the channel after
+    the requested delay; every completed channel adds one back, up to `workers`.
+    """
+
+    def __init__(self, crawl_channel, workers=4, per_guild_limit=2, priority=None, max_retries=5):
+        # crawl_channel is an async callable taking a channel and returning the number of messages inserted
+        self.crawl_channel = crawl_channel
+        self.workers = workers
+        self.per_guild_limit = per_guild_limit
+        self.priority = priority or (lambda channel: -(channel.last_message_id or 0))
+        self.max_retries = max_retries
+        self.concurrency = workers
+
+    async def run(self, channels):
+        """Crawl every channel and return the total number of messages inserted."""
+        loop = asyncio.get_running_loop()
+        self._pending = sorted(channels, key=self.priority)
+        self._total = len(self._pending)
+        self._active = 0
+        self._active_per_guild = Counter()
+        self._attempts = Counter()
+        self._done = 0
+        self._inserted = 0
+        self._started = loop.time()
+        self._condition = asyncio.Condition()
+        logger.info(f'Crawling {self._total} channels with {self.workers} workers, {self.per_guild_limit} per guild')
+        await asyncio.gather(*(self._worker() for _ in range(self.workers)))
+        logger.info(f'Crawled {self._done}/{self._total} channels, {self._inserted} messages in {loop.time() - self._started:.1f}s')
+        return self._inserted
+
+    async def _next_channel(self):
+        async with self._condition:
+            while True:
+                if not self._pending and self._active == 0:
+                    return None
+                if self._active < self.concurrency:
+                    for index, channel in enumerate(self._pending):
+                        if self._active_per_guild[channel.guild.id] < self.per_guild_limit:
+                            del self._pending[index]
+                            self._active += 1
+                            self._active_per_guild[channel.guild.id] += 1
+                            return channel
+                await self._condition.wait()
+
+    async def _release(self, channel, requeue=False):
+        async with self._condition:
+            self._active -= 1
+            self._active_per_guild[channel.guild.id] -= 1
+            if requeue:
+                self._pending.insert(0, channel)
+            self._condition.notify_all()
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            channel = await self._next_channel()
+            if channel is None:
+                return
+            retry_after = None
+            inserted = 0
+            try:
+                inserted = await self.crawl_channel(channel) or 0
+            except discord.RateLimited as e:
+                retry_after = e.retry_after
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    logger.error(f'Error crawling channel {channel.name}: {e}')
+                else:
+                    retry_after = float(e.response.headers.get('Retry-After', 5))
+            except Exception as e:
+                logger.error(f'Error crawling channel {channel.name}: {e}')
+
+            if retry_after is None:
+                self._done += 1
+                self._inserted += inserted
+                self.concurrency = min(self.workers, self.concurrency + 1)
+                logger.info(
+                    f'[{self._done}/{self._total}] Finished channel {channel.name} '
+                    f'({self._inserted} messages so far, {loop.time() - self._started:.1f}s elapsed)'
+                )
+                await self._release(channel)
+                continue
+
+            # Back off: crawl fewer channels at once and retry this one after the delay
+            self._attempts[channel.id] += 1
+            self.concurrency = max(1, self.concurrency // 2)
+            if self._attempts[channel.id] > self.max_retries:
+                self._done += 1
+                logger.error(f'Giving up on channel {channel.name} after {self.max_retries} rate limited attempts')
+                await self._release(channel)
+                continue
+            logger.warning(
+                f'Rate limited on channel {channel.name}, retrying in {retry_after:.1f}s '
+                f'with concurrency {self.concurrency}'
+            )
+            await asyncio.sleep(retry_after)
+            await self._release(channel, requeue=True)
@@ -1,13 +1,286 @@
 import os
 import sqlite3
+import asyncio
 import logging
-from contextlib import closing
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils.timeutil import SQL_NOW_MS, last_snowflake_at_ms, sql_to_epoch_ms
+
+logger = logging.getLogger(__name__)
+
+# IDs bound per IN (...) / VALUES query; keeps even two parameters per ID under
+# SQLite's historical limit of 999 variables
+QUERY_CHUNK_SIZE = 400
+
+
+def seed_channel_checkpoints(conn):
+    """
+    Checkpoint every channel that already has messages at its newest stored message.
+    Those rows predate message IDs, so the checkpoint holds the last snowflake of that
+    millisecond and the first backfill resumes by time instead of re-inserting them.
+    """
+    rows = conn.execute(f'''
+        SELECT channel_id, {sql_to_epoch_ms("MAX(created_at)")} AS last_created_at
+        FROM messages
+        GROUP BY channel_id
+    ''').fetchall()
+    conn.executemany(f'''
+        INSERT OR IGNORE INTO channel_checkpoints (channel_id, last_message_id, last_created_at, updated_at)
+        VALUES (?, ?, ?, {SQL_NOW_MS})
+    ''', ((row[0], str(last_snowflake_at_ms(row[1])), row[1]) for row in rows))
+
+# Versioned schema migrations applied on top of the base tables from create_tables.
+# Migration N is MIGRATIONS[N - 1]: a list of SQL statements or callables taking the
+# connection. The number of the last applied migration is stored in PRAGMA user_version.
+MIGRATIONS = [
+    # 1: indexes for the per-user and time-window lookups on messages
+    [
+        'CREATE INDEX IF NOT EXISTS idx_messages_user_created ON messages (user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_linked_user ON messages (is_linked, user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages (created_at)',
+    ],
+    # 2: one row per user holding their score and activity stats, replacing the
+    # per-message final_score column and the unused scores table
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS user_stats (
+                user_id TEXT PRIMARY KEY,
+                score REAL NOT NULL DEFAULT 0,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                messages_past_month INTEGER NOT NULL DEFAULT 0,
+                first_message TIMESTAMP,
+                last_message TIMESTAMP,
+                is_linked BOOLEAN NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP
+            )
+        ''',
+        '''
+            INSERT OR IGNORE INTO user_stats (user_id, score, message_count, messages_past_month,
+                                              first_message, last_message, is_linked, updated_at)
+            SELECT user_id,
+                   COALESCE(MAX(final_score), 0),
+                   COUNT(*),
+                   SUM(created_at >= datetime('now', '-30 days')),
+                   MIN(created_at),
+                   MAX(created_at),
+                   0,
+                   CURRENT_TIMESTAMP
+            FROM messages
+            GROUP BY user_id
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_user_stats_score ON user_stats (score DESC, user_id)',
+        'DROP TABLE IF EXISTS scores',
+    ],
+    # 3: Discord message IDs for deduplication and per-channel backfill checkpoints
+    [
+        'ALTER TABLE messages ADD COLUMN message_id TEXT',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_message_id ON messages (message_id)',
+        '''
+            CREATE TABLE IF NOT EXISTS channel_checkpoints (
+                channel_id TEXT PRIMARY KEY,
+                last_message_id TEXT NOT NULL,
+                last_created_at TIMESTAMP NOT NULL,
+                updated_at TIMESTAMP
+            )
+        ''',
+        seed_channel_checkpoints,
+    ],
+    # 4: keyset pagination of the linked-only leaderboard
+    [
+        'CREATE INDEX IF NOT EXISTS idx_user_stats_linked_score ON user_stats (is_linked, score DESC, user_id)',
+    ],
+    # 5: Discord to Minecraft account links per SFTP source, synced by LinkedUsers
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS links (
+                discord_id TEXT NOT NULL,
+                minecraft_uuid TEXT NOT NULL,
+                source TEXT NOT NULL,
+                updated_at TIMESTAMP,
+                PRIMARY KEY (source, discord_id)
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_links_discord_id ON links (discord_id)',
+    ],
+    # 6: read position of each append-only link file, so syncs only read the new tail
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS link_sources (
+                source TEXT PRIMARY KEY,
+                byte_offset INTEGER NOT NULL,
+                fingerprint TEXT NOT NULL,
+                updated_at TIMESTAMP
+            )
+        ''',
+    ],
+    # 7: guild members, kept in sync from gateway member events by the MemberSync cog
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS members (
+                guild_id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                username TEXT NOT NULL,
+                joined_at TIMESTAMP,
+                PRIMARY KEY (guild_id, user_id)
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_members_user_id ON members (user_id)',
+    ],
+    # 8: per-user, per-UTC-day, per-channel message counts so windowed counts sum day buckets
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS activity_daily (
+                user_id TEXT NOT NULL,
+                day TEXT NOT NULL,
+                channel_id TEXT NOT NULL,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                first_message TIMESTAMP,
+                last_message TIMESTAMP,
+                PRIMARY KEY (user_id, day, channel_id)
+            ) WITHOUT ROWID
+        ''',
+        '''
+            INSERT INTO activity_daily (user_id, day, channel_id, message_count, first_message, last_message)
+            SELECT user_id, date(created_at), COALESCE(channel_id, ''), COUNT(*), MIN(created_at), MAX(created_at)
+            FROM messages
+            GROUP BY user_id, date(created_at), COALESCE(channel_id, '')
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_activity_daily_day ON activity_daily (day)',
+    ],
+    # 9: messages whose content has not been dropped or compressed yet, for the retention job
+    [
+        '''
+            CREATE INDEX IF NOT EXISTS idx_messages_uncompacted ON messages (created_at)
+            WHERE typeof(content) = 'text' AND content != ''
+        ''',
+    ],
+    # 10: integer epoch-millisecond timestamps everywhere (see utils.timeutil); the
+    # created_at indexes are rebuilt by the update
+    [
+        f'UPDATE messages SET created_at = {sql_to_epoch_ms("created_at")}',
+        f'''
+            UPDATE user_stats SET first_message = {sql_to_epoch_ms("first_message")},
+                                  last_message = {sql_to_epoch_ms("last_message")},
+                                  updated_at = {sql_to_epoch_ms("updated_at")}
+        ''',
+        f'''
+            UPDATE activity_daily SET first_message = {sql_to_epoch_ms("first_message")},
+                                      last_message = {sql_to_epoch_ms("last_message")}
+        ''',
+        f'''
+            UPDATE channel_checkpoints SET last_created_at = {sql_to_epoch_ms("last_created_at")},
+                                           updated_at = {sql_to_epoch_ms("updated_at")}
+        ''',
+        f'UPDATE members SET joined_at = {sql_to_epoch_ms("joined_at")}',
+        f'UPDATE links SET updated_at = {sql_to_epoch_ms("updated_at")}',
+        f'UPDATE link_sources SET updated_at = {sql_to_epoch_ms("updated_at")}',
+    ],
+    # 11: users whose activity or links changed since they were last scored
+    [
+        '''
+            CREATE TABLE IF NOT EXISTS dirty_users (
+                user_id TEXT PRIMARY KEY,
+                marked_at INTEGER NOT NULL
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_dirty_users_marked_at ON dirty_users (marked_at)',
+    ],
+    # 12: the retention job walks messages in (created_at, id) order from a stored cursor,
+    # so messages it keeps as plain text are not revisited on every run
+    [
+        'DROP INDEX IF EXISTS idx_messages_uncompacted',
+        '''
+            CREATE TABLE IF NOT EXISTS retention_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                last_created_at INTEGER NOT NULL,
+                last_id INTEGER NOT NULL,
+                updated_at INTEGER
+            )
+        ''',
+    ],
+    # 13: recompute is_linked from the links table; earlier databases seeded it from the
+    # messages.is_linked heuristic
+    [
+        '''
+            UPDATE user_stats
+            SET is_linked = EXISTS (SELECT 1 FROM links WHERE discord_id = user_stats.user_id)
+        ''',
+    ],
+    # 14: the retention mode the cursor was advanced under, so it restarts when the mode changes
+    [
+        'ALTER TABLE retention_state ADD COLUMN mode TEXT',
+    ],
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# Callbacks run whenever scores are written through this process
+_score_listeners = []
+
+
+def on_scores_changed(callback):
+    """Register a callback to run after scores are written (e.g. to invalidate a cache)."""
+    _score_listeners.append(callback)
+
+
+def notify_scores_changed():
+    for callback in _score_listeners:
+        callback()
+
+# Connection tuning, overridable through the environment. WAL lets readers (the web
+# app, the cogs) keep going while a write is in progress.
+PRAGMAS = {
+    'journal_mode': os.getenv('DB_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.getenv('DB_SYNCHRONOUS', 'NORMAL'),
+    'cache_size': int(os.getenv('DB_CACHE_SIZE', -20000)),  # negative = KiB, so ~20 MB
+    'mmap_size': int(os.getenv('DB_MMAP_SIZE', 256 * 1024 * 1024)),
+    'busy_timeout': int(os.getenv('DB_BUSY_TIMEOUT', 5000)),  # milliseconds
+}
+# Number of prepared statements kept per connection
+CACHED_STATEMENTS = int(os.getenv('DB_CACHED_STATEMENTS', 256))
 
 class Database:
-    def __init__(self, db_path='src/data/messages.db'):
+    # One connection per thread and database file, shared by every Database instance
+    _local = threading.local()
+    _initialized = set()
+    _initialized_lock = threading.Lock()
+
+    def __init__(self, db_path='src/data/messages.db', pragmas=None):
         self.db_path = db_path
-        self.conn = sqlite3.connect(self.db_path)
-        self.create_tables()
+        self.pragmas = {**PRAGMAS, **(pragmas or {})}
+        with Database._initialized_lock:
+            if self.db_path not in Database._initialized:
+                self.initialize_db()
+                Database._initialized.add(self.db_path)
+
+    @property
+    def conn(self):
+        """The calling thread's connection to this database, opened on first use."""
+        connections = getattr(Database._local, 'connections', None)
+        if connections is None:
+            connections = Database._local.connections = {}
+        conn = connections.get(self.db_path)
+        if conn is None:
+            conn = connections[self.db_path] = self._connect()
+        return conn
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.pragmas['busy_timeout'] / 1000,
+            cached_statements=CACHED_STATEMENTS
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {pragma} = {value}')
+        return conn
+
+    def close(self):
+        """Close the calling thread's connection; the next use opens a new one."""
+        connections = getattr(Database._local, 'connections', {})
+        conn = connections.pop(self.db_path, None)
+        if conn is not None:
+            conn.close()
 
     def create_tables(self):
         cursor = self.conn.cursor()
@@ -39,13 +312,6 @@ class Database:
                 flag TEXT
             )
         ''')
-        # Create scores table for potential future use
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS scores (
-                user_id INTEGER,
-                score INTEGER DEFAULT 0
-            )
-        ''')
         # Create users table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -56,8 +322,30 @@ class Database:
         self.conn.commit()
 
     def initialize_db(self):
-        # Called at startup to ensure tables are created
+        # Called at startup to ensure tables are created and up to date
         self.create_tables()
+        self.migrate()
+
+    def get_schema_version(self):
+        return self.conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def migrate(self):
+        """Upgrade the database in place to SCHEMA_VERSION, one transaction per migration."""
+        version = self.get_schema_version()
+        for target in range(version + 1, SCHEMA_VERSION + 1):
+            logger.info(f"Migrating {self.db_path} to schema version {target}")
+            try:
+                self.conn.execute('BEGIN')
+                for step in MIGRATIONS[target - 1]:
+                    if callable(step):
+                        step(self.conn)
+                    else:
+                        self.conn.execute(step)
+                self.conn.execute(f'PRAGMA user_version = {target}')
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
 
     def add_flag(self, user_id, flag):
         cursor = self.conn.cursor()
@@ -71,12 +359,115 @@ class Database:
         return [row[0] for row in rows]
 
     def update_final_score(self, user_id, score):
-        cursor = self.conn.cursor()
-        cursor.execute('UPDATE messages SET final_score = ? WHERE user_id = ?', (score, str(user_id)))
-        self.conn.commit()
+        self.update_final_scores([(user_id, score)])
+
+    def update_final_scores(self, scores):
+        """
+        Write many (user_id, score) pairs to user_stats in a single transaction. Users
+        without a user_stats row (i.e. without messages) are left out, so they never
+        show up on the leaderboard.
+        """
+        with self.conn:
+            self.conn.executemany(f'''
+                UPDATE user_stats SET score = ?, updated_at = {SQL_NOW_MS}
+                WHERE user_id = ?
+            ''', ((score, str(user_id)) for user_id, score in scores))
+        notify_scores_changed()
+
+    def update_user_stats(self, stats):
+        """
+        Upsert the score and activity stats of many users in a single transaction.
+        Each item is a dict with user_id, score, message_count, messages_past_month,
+        first_message and last_message. Users with no messages are skipped, so looking
+        one up never adds them to the leaderboard.
+        """
+        with self.conn:
+            self.conn.executemany(f'''
+                INSERT INTO user_stats (user_id, score, message_count, messages_past_month,
+                                        first_message, last_message, updated_at)
+                VALUES (:user_id, :score, :message_count, :messages_past_month,
+                        :first_message, :last_message, {SQL_NOW_MS})
+                ON CONFLICT(user_id) DO UPDATE SET
+                    score = excluded.score,
+                    message_count = excluded.message_count,
+                    messages_past_month = excluded.messages_past_month,
+                    first_message = excluded.first_message,
+                    last_message = excluded.last_message,
+                    updated_at = excluded.updated_at
+            ''', ({**row, "user_id": str(row["user_id"])} for row in stats if row["message_count"] > 0))
+        notify_scores_changed()
 
     def get_db_connection(self):
-        """Return a new database connection with row factory set."""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        return conn
+        """
+        Return the calling thread's connection (row factory set). Use it as a context
+        manager to commit; it stays open for reuse and must not be closed by callers.
+        """
+        return self.conn
+
+
+class AsyncDatabase:
+    """
+    Async access to the database for code running on the event loop. All work runs on
+    one dedicated thread that owns a long-lived Database, so queries never block the
+    loop and writes are serialised.
+    """
+
+    def __init__(self, db_path='src/data/messages.db'):
+        self.db_path = db_path
+        self._database = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='database')
+
+    def _get_database(self):
+        # Only ever called on the database thread, which owns the connection
+        if self._database is None:
+            self._database = Database(self.db_path)
+        return self._database
+
+    async def _submit(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def run(self, fn, *args):
+        """Run fn(conn, *args) on the database thread inside a transaction and return its result."""
+        def work():
+            conn = self._get_database().conn
+            with conn:
+                return fn(conn, *args)
+        return await self._submit(work)
+
+    async def run_outside_transaction(self, fn, *args):
+        """Run fn(conn, *args) on the database thread with no transaction open, e.g. for VACUUM."""
+        return await self._submit(lambda: fn(self._get_database().conn, *args))
+
+    async def call(self, method, *args):
+        """Call a Database method by name on the database thread."""
+        return await self._submit(lambda: getattr(self._get_database(), method)(*args))
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def executemany(self, sql, seq_of_params):
+        return await self.run(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    def close(self):
+        self._executor.submit(lambda: self._database and self._database.close())
+        self._executor.shutdown(wait=True)
+
+
+_async_database = None
+_async_database_lock = threading.Lock()
+
+
+def get_async_database():
+    """Return the AsyncDatabase shared by every cog."""
+    global _async_database
+    with _async_database_lock:
+        if _async_database is None:
+            _async_database = AsyncDatabase()
+        return _async_database
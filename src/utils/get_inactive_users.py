@@ -1,34 +1,66 @@
-import discord
-import datetime
-import pytz
-import os
-import sys
-from utils.db import Database
+from utils.db import get_async_database
+from utils.timeutil import days_ago_ms, to_epoch_ms
+
+# Default window for "has messaged recently"
+INACTIVE_DAYS = 30
+
+
+def sync_guild_members(conn, guild_id, members):
+    """Replace the stored members of a guild with `members`, a list of (user_id, username, joined_at)."""
+    guild_id = str(guild_id)
+    current = {str(user_id) for user_id, _, _ in members}
+    stored = {row[0] for row in conn.execute('SELECT user_id FROM members WHERE guild_id = ?', (guild_id,))}
+    conn.executemany('DELETE FROM members WHERE guild_id = ? AND user_id = ?',
+                     [(guild_id, user_id) for user_id in stored - current])
+    upsert_members(conn, guild_id, members)
+
+
+def upsert_members(conn, guild_id, members):
+    conn.executemany('''
+        INSERT INTO members (guild_id, user_id, username, joined_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(guild_id, user_id) DO UPDATE SET
+            username = excluded.username,
+            joined_at = excluded.joined_at
+    ''', [(str(guild_id), str(user_id), username, to_epoch_ms(joined_at)) for user_id, username, joined_at in members])
+
+
+def remove_member(conn, guild_id, user_id):
+    conn.execute('DELETE FROM members WHERE guild_id = ? AND user_id = ?', (str(guild_id), str(user_id)))
+
+
+def remove_guild(conn, guild_id):
+    conn.execute('DELETE FROM members WHERE guild_id = ?', (str(guild_id),))
+
 
 class UserActivity:
+    """
+    Inactivity is computed in SQL from the members table (synced from gateway events)
+    and the per-user aggregates in user_stats. A member is inactive when they are not
+    linked or have not messaged within `days` days.
+    """
+
     def __init__(self, bot):
         self.bot = bot
-        self.db = Database()
-
-    async def get_inactive_users(self):
-        all_members = self.bot.get_all_members()
-        active_user_ids = set()
-        with self.db.get_db_connection() as conn:
-            result = conn.execute('''
-                SELECT user_id FROM messages WHERE is_linked = 1
-            ''').fetchall()
-            for row in result:
-                active_user_ids.add(row['user_id'])
-        inactive_users = [member.name for member in all_members if str(member.id) not in active_user_ids]
-        return inactive_users
+        self.db = get_async_database()
 
-    async def get_active_user_count(self):
-        active_user_ids = set()
-        with self.db.get_db_connection() as conn:
-            result = conn.execute('''
-                SELECT COUNT(DISTINCT user_id) as active_user_count FROM messages
-            ''').fetchone()
-            active_user_count = result['active_user_count']
-        print(f"Active users count: {active_user_count}")
-        return active_user_count
+    async def get_inactivity_counts(self, days=INACTIVE_DAYS):
+        """Count members, unlinked members, members without messages in `days` days, and inactive members."""
+        since = days_ago_ms(days)
+        result = await self.db.fetchone('''
+            WITH member_ids AS (SELECT DISTINCT user_id FROM members)
+            SELECT COUNT(*) as members,
+                   COALESCE(SUM(COALESCE(s.is_linked, 0) = 0), 0) as unlinked,
+                   COALESCE(SUM(s.last_message IS NULL OR s.last_message < ?), 0) as no_recent_messages,
+                   COALESCE(SUM(COALESCE(s.is_linked, 0) = 0 OR s.last_message IS NULL OR s.last_message < ?), 0) as inactive
+            FROM member_ids mi
+            LEFT JOIN user_stats s ON s.user_id = mi.user_id
+        ''', (since, since))
+        return dict(result)
 
+    async def get_active_user_count(self):
+        result = await self.db.fetchone('''
+            SELECT COUNT(*) as active_user_count FROM user_stats
+            WHERE message_count > 0
+        ''')
+        return result['active_user_count']
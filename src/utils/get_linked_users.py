@@ -1,97 +1,261 @@
 import sys
 import os
-import paramiko
-import json
-import pandas as pd
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from Variables.sensitiveVars import SensitiveVariables
-from utils.db import Database
+from utils.db import QUERY_CHUNK_SIZE, Database
+from utils.timeutil import SQL_NOW_MS
+from utils.user_scores import mark_dirty_users
 
-class LinkedUsers:
-    def __init__(self):
-        self.sensitive_vars = SensitiveVariables()
-        self.db = Database()
+logger = logging.getLogger(__name__)
 
-    def load_user_data(self):
-        """
-        Loads user data from multiple SFTP sources defined in `sensitive_vars.sftp_sources`.
-        The function connects to each SFTP server, reads a user data file, parses the data,
-        and merges it into a single list of dictionaries. Each dictionary maps a Discord
-        ID to a Minecraft UUID.
-        Returns:
-            pd.DataFrame: A DataFrame where each row contains a Discord ID and a Minecraft UUID.
-        Raises:
-            Exception: If there is an error connecting to an SFTP server or reading/parsing the user data file.
-        Logs:
-            - A warning if an SFTP source configuration is incomplete.
-            - Notices and info messages for connection and file operations.
-            - Success messages upon successful data loading.
-            - Error messages if any exceptions occur during the process.
-        """
-        user_data = []
+# Bytes at the start of a link file, and just before the last read offset, hashed to
+# detect it being rewritten or rotated
+FINGERPRINT_BYTES = 4096
 
-        sftp_host = self.sensitive_vars.sftp_sources[0].get('host')
-        sftp_port = self.sensitive_vars.sftp_sources[0].get('port')
-        sftp_path = self.sensitive_vars.sftp_sources[0].get('path')
 
-        for sftp_source in self.sensitive_vars.sftp_sources[1:]:
-            sftp_username = sftp_source.get('username')
-            sftp_password = sftp_source.get('password')
+@contextmanager
+def open_sftp_file(source):
+    """Open a source's link file over SFTP for binary reading."""
+    import paramiko  # Imported on first use to keep bot startup fast
 
-            if not all([sftp_host, sftp_port, sftp_path, sftp_username, sftp_password]):
-                continue
+    transport = paramiko.Transport((source['host'], source['port']))
+    try:
+        transport.connect(username=source['username'], password=source['password'])
+        sftp = paramiko.SFTPClient.from_transport(transport)
+        with sftp.open(source['path'], 'rb') as file:
+            yield file
+        sftp.close()
+    finally:
+        transport.close()
+
+
+def open_local_file(source):
+    """Local stand-in for open_sftp_file that reads `path` from the filesystem (used for testing)."""
+    return open(source['path'], 'rb')
+
+
+def file_fingerprint(file, length):
+    """Hash the first and the last FINGERPRINT_BYTES of the first `length` bytes of a file."""
+    file.seek(0)
+    digest = hashlib.sha1(file.read(min(length, FINGERPRINT_BYTES)))
+    if length > FINGERPRINT_BYTES:
+        file.seek(max(length - FINGERPRINT_BYTES, FINGERPRINT_BYTES))
+        digest.update(file.read(length - file.tell()))
+    return digest.hexdigest()
+
+
+def at_line_start(file, offset):
+    """Return whether `offset` is the start of a line, i.e. the byte before it is a newline."""
+    if offset == 0:
+        return True
+    file.seek(offset - 1)
+    return file.read(1) == b'\n'
+
+
+def iter_complete_lines(file, counter):
+    """Yield the newline-terminated lines of a file, adding their size to counter[0]; a trailing partial line is left for the next read."""
+    for line in file:
+        if not line.endswith(b'\n'):
+            return
+        counter[0] += len(line)
+        yield line
+
+
+def iter_aof_entries(lines):
+    """
+    Parse lines of the form:
+        <discord_id> <minecraft_uuid>
+    yielding (discord_id, minecraft_uuid) pairs one line at a time.
+    """
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        discord_id, minecraft_uuid = line.split(maxsplit=1)
+        yield discord_id, minecraft_uuid
 
-            try:
-                transport = paramiko.Transport((sftp_host, sftp_port))
-                transport.connect(username=sftp_username, password=sftp_password)
-                sftp = paramiko.SFTPClient.from_transport(transport)
 
-                with sftp.open(sftp_path, 'r') as file:
-                    aof_data = file.read().decode('utf-8')
-                    user_data_json = self.parse_aof_data(aof_data)
-                    source_user_data = json.loads(user_data_json)
+class LinkedUsers:
+    def __init__(self, opener=open_sftp_file, database=None):
+        # opener(source) returns a context manager yielding the source's link file
+        self.sensitive_vars = SensitiveVariables()
+        self.db = database or Database()
+        self.opener = opener
 
-                sftp.close()
-                transport.close()
+    def get_sources(self):
+        """
+        Build one source per SFTP account in `sensitive_vars.sftp_sources`: the first entry
+        holds the shared host, port and path, the others the per-server credentials.
+        Incomplete sources are skipped with a warning.
+        """
+        shared = self.sensitive_vars.sftp_sources[0]
+        sources = []
+        for credentials in self.sensitive_vars.sftp_sources[1:]:
+            source = {
+                "name": credentials.get('username'),
+                "host": shared.get('host'),
+                "port": shared.get('port'),
+                "path": shared.get('path'),
+                "username": credentials.get('username'),
+                "password": credentials.get('password')
+            }
+            if not all(source.values()):
+                logger.warning(f"Skipping incomplete SFTP source: {source['name']}")
+                continue
+            sources.append(source)
+        return sources
 
-                user_data.extend(source_user_data)
-            except Exception as e:
-                print(f"Error: {e}")
+    def fetch_source(self, source, state=None):
+        """
+        Read one source's link file into {discord_id: minecraft_uuid}. With the `state`
+        (byte_offset, fingerprint) of the previous sync, only the lines appended since
+        are read. If the file shrank, its start or the bytes already read changed, or the
+        offset no longer starts a line, it was truncated, rotated or rewritten, and the
+        whole file is reloaded. Returns (entries, full_reload, new_state).
+        """
+        with self.opener(source) as file:
+            file.seek(0, os.SEEK_END)
+            size = file.tell()
+            offset = 0
+            if state is not None and size >= state['byte_offset'] and \
+                    at_line_start(file, state['byte_offset']) and \
+                    file_fingerprint(file, state['byte_offset']) == state['fingerprint']:
+                offset = state['byte_offset']
+            elif state is not None:
+                logger.info(f"Link file for {source['name']} was truncated or rotated, reloading it")
+            file.seek(offset)
+            if hasattr(file, 'prefetch'):
+                # Pipeline the SFTP reads of the unread tail only, from the current position
+                file.prefetch(size)
+            counter = [offset]
+            entries = dict(iter_aof_entries(iter_complete_lines(file, counter)))
+            new_state = {"byte_offset": counter[0], "fingerprint": file_fingerprint(file, counter[0])}
+        return entries, offset == 0, new_state
 
+    def sync_links(self, sources=None):
+        """
+        Fetch every source concurrently and bring the `links` table in line with them in
+        one transaction, writing only what changed. A full read of a source replaces its
+        links; an incremental read of an appended tail only adds or updates links.
+        Sources that fail to load keep their previous links. Returns a summary with the
+        counts and the Discord IDs whose linked status or link changed.
+        """
+        sources = self.get_sources() if sources is None else sources
         with self.db.get_db_connection() as conn:
-            with conn:
-                for entry in user_data:
-                    conn.execute('''
-                        UPDATE messages
-                        SET is_linked = 1
-                        WHERE user_id = ?
-                    ''', (entry['discord_id'],))
+            states = {row['source']: row for row in conn.execute('SELECT * FROM link_sources')}
+        fetched = {}
+        if sources:
+            with ThreadPoolExecutor(max_workers=len(sources)) as pool:
+                futures = {
+                    source['name']: pool.submit(self.fetch_source, source, states.get(source['name']))
+                    for source in sources
+                }
+            for name, future in futures.items():
+                try:
+                    fetched[name] = future.result()
+                except Exception as e:
+                    logger.error(f"Error loading links from {name}: {e}")
 
-        return pd.DataFrame(user_data)
+        summary = {"added": 0, "updated": 0, "removed": 0, "changed_users": set()}
+        with self.db.get_db_connection() as conn:
+            for name, (links, full_reload, state) in fetched.items():
+                if full_reload:
+                    current = {
+                        row['discord_id']: row['minecraft_uuid']
+                        for row in conn.execute('SELECT discord_id, minecraft_uuid FROM links WHERE source = ?', (name,))
+                    }
+                    removed = [(discord_id, name) for discord_id in current.keys() - links.keys()]
+                else:
+                    current = self._current_links(conn, name, links.keys())
+                    removed = []
+                upserts = [(discord_id, uuid, name) for discord_id, uuid in links.items() if current.get(discord_id) != uuid]
+                conn.executemany(f'''
+                    INSERT INTO links (discord_id, minecraft_uuid, source, updated_at)
+                    VALUES (?, ?, ?, {SQL_NOW_MS})
+                    ON CONFLICT(source, discord_id) DO UPDATE SET
+                        minecraft_uuid = excluded.minecraft_uuid,
+                        updated_at = excluded.updated_at
+                ''', upserts)
+                conn.executemany('DELETE FROM links WHERE discord_id = ? AND source = ?', removed)
+                conn.execute(f'''
+                    INSERT INTO link_sources (source, byte_offset, fingerprint, updated_at)
+                    VALUES (?, ?, ?, {SQL_NOW_MS})
+                    ON CONFLICT(source) DO UPDATE SET
+                        byte_offset = excluded.byte_offset,
+                        fingerprint = excluded.fingerprint,
+                        updated_at = excluded.updated_at
+                ''', (name, state['byte_offset'], state['fingerprint']))
+                summary["added"] += sum(1 for discord_id, _, _ in upserts if discord_id not in current)
+                summary["updated"] += sum(1 for discord_id, _, _ in upserts if discord_id in current)
+                summary["removed"] += len(removed)
+                summary["changed_users"].update(discord_id for discord_id, _, _ in upserts)
+                summary["changed_users"].update(discord_id for discord_id, _ in removed)
+            # A full reload rechecks every user, clearing flags no tail read would revisit
+            full_sync = any(full_reload for _, full_reload, _ in fetched.values())
+            summary["changed_users"].update(
+                self._refresh_linked_status(conn, None if full_sync else summary["changed_users"])
+            )
+            mark_dirty_users(conn, summary["changed_users"])
+        logger.info(
+            f"Link sync: {summary['added']} added, {summary['updated']} updated, "
+            f"{summary['removed']} removed from {len(fetched)}/{len(sources)} sources"
+        )
+        return summary
+
+    def _current_links(self, conn, source, discord_ids):
+        """Return the stored {discord_id: minecraft_uuid} of a source for the given users only."""
+        discord_ids = list(discord_ids)
+        current = {}
+        for start in range(0, len(discord_ids), QUERY_CHUNK_SIZE):
+            chunk = discord_ids[start:start + QUERY_CHUNK_SIZE]
+            placeholders = ', '.join('?' for _ in chunk)
+            current.update(conn.execute(
+                f'SELECT discord_id, minecraft_uuid FROM links WHERE source = ? AND discord_id IN ({placeholders})',
+                (source, *chunk)
+            ).fetchall())
+        return current
 
-    def parse_aof_data(self, aof_data):
+    def _refresh_linked_status(self, conn, discord_ids=None):
         """
-        Accepts a string containing lines of the form:
-            <discord_id> <minecraft_uuid>
-        and returns a JSON string containing a list of objects with
-        "discord_id" and "minecraft_uuid".
+        Recompute is_linked from the links table for the given users, or for every
+        user_stats row when `discord_ids` is None. Returns the users whose flag flipped.
         """
-        lines = aof_data.strip().splitlines()
-        entries = []
+        query = '''
+            UPDATE user_stats SET is_linked = NOT is_linked
+            WHERE is_linked != EXISTS (SELECT 1 FROM links WHERE discord_id = user_stats.user_id)
+        '''
+        if discord_ids is None:
+            return {row[0] for row in conn.execute(query + ' RETURNING user_id')}
+        discord_ids = list(discord_ids)
+        flipped = set()
+        for start in range(0, len(discord_ids), QUERY_CHUNK_SIZE):
+            chunk = discord_ids[start:start + QUERY_CHUNK_SIZE]
+            placeholders = ', '.join('?' for _ in chunk)
+            flipped.update(row[0] for row in conn.execute(
+                query + f' AND user_id IN ({placeholders}) RETURNING user_id', chunk
+            ))
+        return flipped
 
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-            discord_id, minecraft_uuid = line.split(maxsplit=1)
-            entries.append({
-                "discord_id": discord_id,
-                "minecraft_uuid": minecraft_uuid
-            })
+    def load_user_data(self):
+        """
+        Syncs links from every SFTP source (see sync_links) and returns all stored links.
+        Returns:
+            pd.DataFrame: A DataFrame where each row contains a Discord ID, a Minecraft UUID and its source.
+        """
+        import pandas as pd  # Imported on first use to keep bot startup fast
 
-        return json.dumps(entries, indent=2)
+        self.sync_links()
+        with self.db.get_db_connection() as conn:
+            rows = conn.execute('SELECT discord_id, minecraft_uuid, source FROM links').fetchall()
+        return pd.DataFrame([dict(row) for row in rows], columns=['discord_id', 'minecraft_uuid', 'source'])
 
 if __name__ == "__main__":
     linked_users = LinkedUsers()
-    print(linked_users.load_user_data())
\ No newline at end of file
+    print(linked_users.load_user_data())
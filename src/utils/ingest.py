@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import os
+import sqlite3
+from utils.db import get_async_database
+from utils.activity_daily import record_daily_activity
+from utils.db import QUERY_CHUNK_SIZE
+from utils.user_scores import mark_dirty_users
+from utils.timeutil import SQL_NOW_MS, days_ago_ms, now_ms, to_epoch_ms
+
+logger = logging.getLogger(__name__)
+
+# Metadata-only mode: set INGEST_STORE_CONTENT=0 to never store message text
+STORE_CONTENT = os.getenv('INGEST_STORE_CONTENT', '1') != '0'
+# Attempts at writing a batch when the database is busy or locked, and the first retry delay
+FLUSH_RETRIES = 5
+FLUSH_RETRY_DELAY = 0.5
+
+
+def record_messages(conn, rows, now=None, store_content=STORE_CONTENT):
+    """
+    Insert message rows of the form (message_id, user_id, username, channel_id, content,
+    created_at), with created_at in epoch milliseconds, fold them into the per-user
+    counters in user_stats and the activity_daily buckets, and queue the affected users
+    for rescoring. New user_stats rows take their linked status from the links table.
+    With `store_content` off the message text is stored as ''. Messages whose Discord ID
+    is already stored are skipped. Runs inside the caller's transaction.
+    Returns the per-user aggregate of the inserted rows as
+    {user_id: [count, count_past_month, first_message, last_message]}.
+    """
+    now = now or now_ms()
+    one_month_ago = days_ago_ms(30, now)
+    rows = list({row[0]: row for row in rows}.values())
+    existing = set()
+    for start in range(0, len(rows), QUERY_CHUNK_SIZE):
+        chunk = [row[0] for row in rows[start:start + QUERY_CHUNK_SIZE]]
+        placeholders = ', '.join('?' for _ in chunk)
+        existing.update(row[0] for row in conn.execute(
+            f'SELECT message_id FROM messages WHERE message_id IN ({placeholders})', chunk
+        ))
+    rows = [row for row in rows if row[0] not in existing]
+    if not store_content:
+        rows = [(*row[:4], '', row[5]) for row in rows]
+
+    activity = {}
+    users = {}
+    for message_id, user_id, username, channel_id, content, created_at in rows:
+        users[user_id] = username
+        entry = activity.setdefault(user_id, [0, 0, created_at, created_at])
+        entry[0] += 1
+        if created_at >= one_month_ago:
+            entry[1] += 1
+        entry[2] = min(entry[2], created_at)
+        entry[3] = max(entry[3], created_at)
+
+    conn.executemany('''
+        INSERT OR IGNORE INTO messages (message_id, user_id, username, channel_id, content, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', rows)
+    record_daily_activity(conn, rows)
+    conn.executemany('''
+        INSERT OR IGNORE INTO users (id, username)
+        VALUES (?, ?)
+    ''', users.items())
+    conn.executemany(f'''
+        INSERT INTO user_stats (user_id, message_count, messages_past_month, first_message, last_message,
+                                is_linked, updated_at)
+        VALUES (?, ?, ?, ?, ?, EXISTS (SELECT 1 FROM links WHERE discord_id = ?), {SQL_NOW_MS})
+        ON CONFLICT(user_id) DO UPDATE SET
+            message_count = message_count + excluded.message_count,
+            messages_past_month = messages_past_month + excluded.messages_past_month,
+            first_message = MIN(COALESCE(first_message, excluded.first_message), excluded.first_message),
+            last_message = MAX(COALESCE(last_message, excluded.last_message), excluded.last_message),
+            updated_at = excluded.updated_at
+    ''', ((user_id, *entry, user_id) for user_id, entry in activity.items()))
+    mark_dirty_users(conn, activity.keys(), now)
+    return activity
+
+
+class MessageIngestor:
+    """
+    Write-behind buffer for live messages. Messages are queued in memory and written
+    to sqlite in batched transactions once `batch_size` rows are waiting or
+    `flush_interval` seconds have passed since the first one. Producers wait when
+    `max_queue_size` rows are pending, and close() flushes whatever is left.
+    """
+
+    def __init__(self, database=None, batch_size=500, flush_interval=5.0, max_queue_size=10000):
+        self.database = database or get_async_database()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, message):
+        """Queue a discord message for insertion, waiting if the queue is full."""
+        if self.queue.full():
+            logger.warning(f"Ingest queue full ({self.queue.qsize()} messages), waiting for a flush")
+        await self.queue.put((
+            str(message.id),
+            str(message.author.id),
+            message.author.name,
+            str(message.channel.id),
+            message.content,
+            to_epoch_ms(message.created_at)
+        ))
+
+    async def close(self):
+        """Flush every queued message and stop the writer."""
+        if self._task is None:
+            return
+        await self.queue.put(None)
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            row = await self.queue.get()
+            if row is None:
+                return
+            batch = [row]
+            deadline = loop.time() + self.flush_interval
+            stopping = False
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if row is None:
+                    stopping = True
+                    break
+                batch.append(row)
+            await self._flush(batch)
+            if stopping:
+                return
+
+    async def _flush(self, batch):
+        # Another process (populate_db, link sync) can hold the write lock for a while,
+        # so retry busy/locked errors with backoff before giving up on the batch
+        delay = FLUSH_RETRY_DELAY
+        for attempt in range(1, FLUSH_RETRIES + 1):
+            try:
+                await self.database.run(record_messages, batch)
+                logger.info(f"Ingested {len(batch)} messages")
+                return
+            except sqlite3.OperationalError as e:
+                if attempt == FLUSH_RETRIES:
+                    logger.error(f"Dropping {len(batch)} messages after {attempt} attempts: {e}")
+                    return
+                logger.warning(f"Error ingesting {len(batch)} messages (attempt {attempt}), retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+                delay *= 2
+            except Exception as e:
+                logger.error(f"Error ingesting {len(batch)} messages: {e}")
+                return
@@ -0,0 +1,166 @@
+import base64
+import datetime
+import hashlib
+import json
+import logging
+import threading
+import time
+from utils.db import Database, on_scores_changed
+from utils.timeutil import days_ago_ms
+
+logger = logging.getLogger(__name__)
+
+# Seconds a ranking is served before it is rebuilt even without an invalidation
+RANKING_TTL = 60
+# Largest page served by LeaderboardService.page
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(score, user_id, rank):
+    """Encode the position after the last entry of a page as an opaque string."""
+    return base64.urlsafe_b64encode(json.dumps([score, user_id, rank]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decode a cursor from encode_cursor into (score, user_id, rank); raises ValueError if malformed."""
+    try:
+        score, user_id, rank = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(score), str(user_id), int(rank)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+class Ranking:
+    """An immutable snapshot of the leaderboard, best score first."""
+    __slots__ = ("entries", "etag", "last_modified", "built_at")
+
+    def __init__(self, entries, etag, last_modified, built_at):
+        self.entries = entries  # tuple of (user_id, username, score)
+        self.etag = etag
+        self.last_modified = last_modified
+        self.built_at = built_at
+
+
+class LeaderboardService:
+    """
+    Serves the ranking from an in-memory snapshot of user_stats. The snapshot is rebuilt
+    when scores are written in this process (see utils.db.on_scores_changed) or once it
+    is older than `ttl` seconds, which covers writers in other processes.
+    """
+
+    def __init__(self, database=None, ttl=RANKING_TTL):
+        self.database = database or Database()
+        self.ttl = ttl
+        self._ranking = None
+        self._stale = True
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._stale = True
+
+    def get_ranking(self):
+        ranking = self._ranking
+        if ranking is not None and not self._stale and time.monotonic() - ranking.built_at < self.ttl:
+            return ranking
+        with self._lock:
+            ranking = self._ranking
+            if ranking is None or self._stale or time.monotonic() - ranking.built_at >= self.ttl:
+                self._stale = False
+                ranking = self._ranking = self._build(ranking)
+        return ranking
+
+    def top(self, limit):
+        """Return the best `limit` entries and the ranking they come from."""
+        ranking = self.get_ranking()
+        return ranking.entries[:max(limit, 0)], ranking
+
+    def page(self, limit=50, cursor=None, linked_only=False, active_days=None, user_id=None):
+        """
+        Return one page of the ranking, ordered by (score DESC, user_id), using keyset
+        pagination so every page costs the same as the first. `cursor` is the
+        next_cursor of the previous page. Filters: only linked users, and only users
+        who messaged within `active_days` days. If `user_id` is given, that user's rank
+        under the same filters is included.
+        """
+        limit = min(max(limit, 1), MAX_PAGE_SIZE)
+        filters = []
+        params = []
+        if linked_only:
+            filters.append('s.is_linked = 1')
+        if active_days is not None:
+            filters.append('s.last_message >= ?')
+            params.append(days_ago_ms(active_days))
+
+        page_filters = list(filters)
+        page_params = list(params)
+        rank = 0
+        if cursor is not None:
+            after_score, after_user_id, rank = decode_cursor(cursor)
+            page_filters.append('s.score <= ? AND (s.score < ? OR s.user_id > ?)')
+            page_params.extend((after_score, after_score, after_user_id))
+        where = f"WHERE {' AND '.join(page_filters)}" if page_filters else ''
+
+        with self.database.get_db_connection() as conn:
+            rows = conn.execute(f'''
+                SELECT s.user_id, COALESCE(u.username, s.user_id) as username, s.score
+                FROM user_stats s
+                LEFT JOIN users u ON u.id = s.user_id
+                {where}
+                ORDER BY s.score DESC, s.user_id
+                LIMIT ?
+            ''', (*page_params, limit + 1)).fetchall()
+            user = self._user_rank(conn, user_id, filters, params) if user_id is not None else None
+
+        entries = [
+            {"rank": rank + index + 1, "user_id": row['user_id'], "username": row['username'], "score": row['score']}
+            for index, row in enumerate(rows[:limit])
+        ]
+        next_cursor = None
+        if len(rows) > limit:
+            last = entries[-1]
+            next_cursor = encode_cursor(last["score"], last["user_id"], last["rank"])
+        return {"entries": entries, "next_cursor": next_cursor, "user": user}
+
+    def _user_rank(self, conn, user_id, filters, params):
+        row = conn.execute(
+            f"SELECT user_id, score FROM user_stats s WHERE {' AND '.join(['s.user_id = ?', *filters])}",
+            (str(user_id), *params)
+        ).fetchone()
+        if row is None:
+            return None
+        ahead = conn.execute(f'''
+            SELECT COUNT(*) FROM user_stats s
+            WHERE {' AND '.join(['s.score >= ? AND (s.score > ? OR s.user_id < ?)', *filters])}
+        ''', (row['score'], row['score'], row['user_id'], *params)).fetchone()[0]
+        return {"user_id": row['user_id'], "rank": ahead + 1, "score": row['score']}
+
+    def _build(self, previous):
+        with self.database.get_db_connection() as conn:
+            rows = conn.execute('''
+                SELECT s.user_id, COALESCE(u.username, s.user_id) as username, s.score
+                FROM user_stats s
+                LEFT JOIN users u ON u.id = s.user_id
+                ORDER BY s.score DESC, s.user_id
+            ''').fetchall()
+        entries = tuple((row['user_id'], row['username'], row['score']) for row in rows)
+        etag = hashlib.sha1(repr(entries).encode()).hexdigest()[:16]
+        if previous is not None and previous.etag == etag:
+            last_modified = previous.last_modified
+        else:
+            last_modified = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+            logger.info(f"Leaderboard rebuilt with {len(entries)} users")
+        return Ranking(entries, etag, last_modified, time.monotonic())
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_leaderboard_service():
+    """Return the LeaderboardService shared by the web app and the bot."""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = LeaderboardService()
+            on_scores_changed(_service.invalidate)
+        return _service
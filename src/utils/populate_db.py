@@ -5,12 +5,14 @@ import logging
 import datetime
 import pytz
 import sys
-import asyncio  # For concurrent tasks
 import sqlite3
-from datetime import timezone, datetime, timedelta  # Import timedelta
+from datetime import datetime, timedelta  # Import timedelta
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from Variables.sensitiveVars import SensitiveVariables
-from utils.db import Database
+from utils.db import get_async_database
+from utils.ingest import record_messages
+from utils.channel_crawler import ChannelCrawler
+from utils.timeutil import SQL_NOW_MS, to_epoch_ms
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -21,12 +23,16 @@ sensitive_vars = SensitiveVariables()
 
 intents = discord.Intents.all()
 intents.message_content = True  # Enable the message content intent
-bot = commands.Bot(command_prefix=',', intents=intents)
+# Surface long rate limits as discord.RateLimited so the crawler can back off
+bot = commands.Bot(command_prefix=',', intents=intents, max_ratelimit_timeout=30.0)
 
-db = Database()
+db = get_async_database()
 
-def get_db_connection():
-    return db.get_db_connection()
+# Number of messages written per transaction while streaming a channel's history
+CHUNK_SIZE = 1000
+# Number of channels crawled at once, overall and per guild
+CRAWLER_WORKERS = 4
+CRAWLER_PER_GUILD_LIMIT = 2
 
 @bot.event
 async def on_ready():
@@ -39,119 +45,92 @@ async def on_ready():
 async def populate_db():
     logger.info('Populating database with messages from the past month')
     one_month_ago = datetime.now(pytz.utc) - timedelta(days=30)  # Use timedelta correctly
-    tasks = []
-    # Create a task for each text channel in every guild
-    for guild in bot.guilds:
-        for channel in guild.text_channels:
-            tasks.append(fetch_and_insert_channel_messages(channel, one_month_ago))
-    await asyncio.gather(*tasks)
+    # Crawl the channels with the most stored messages first, then the most recently active
+    activity = await get_channel_activity()
+    crawler = ChannelCrawler(
+        lambda channel: fetch_and_insert_channel_messages(channel, one_month_ago),
+        workers=CRAWLER_WORKERS,
+        per_guild_limit=CRAWLER_PER_GUILD_LIMIT,
+        priority=lambda channel: (-activity.get(str(channel.id), 0), -(channel.last_message_id or 0))
+    )
+    channels = [channel for guild in bot.guilds for channel in guild.text_channels]
+    await crawler.run(channels)
     logger.info('All channels processed.')
 
+async def get_channel_activity():
+    """Return the number of stored messages per channel ID."""
+    rows = await db.fetchall('''
+        SELECT channel_id, COUNT(*) as message_count FROM messages
+        GROUP BY channel_id
+    ''')
+    return {row['channel_id']: row['message_count'] for row in rows}
+
+async def get_channel_checkpoint(channel_id):
+    """
+    Return the last ingested message of a channel, or None if it was never backfilled.
+    For channels stored before message IDs existed this is a time-based placeholder
+    snowflake seeded by migration 3.
+    """
+    return await db.fetchone('''
+        SELECT last_message_id, last_created_at FROM channel_checkpoints
+        WHERE channel_id = ?
+    ''', (str(channel_id),))
+
+def write_chunk(conn, channel, messages_to_insert, last_message):
+    """
+    Insert a chunk of raw messages, fold them into the per-user stats, queue the authors for rescoring, and
+    advance the channel checkpoint. Run through db.run, so all of it is one transaction.
+    """
+    # Messages already stored (e.g. by an interrupted run) are skipped on message_id
+    activity = record_messages(conn, messages_to_insert)
+    conn.execute(f'''
+        INSERT INTO channel_checkpoints (channel_id, last_message_id, last_created_at, updated_at)
+        VALUES (?, ?, ?, {SQL_NOW_MS})
+        ON CONFLICT(channel_id) DO UPDATE SET
+            last_message_id = excluded.last_message_id,
+            last_created_at = excluded.last_created_at,
+            updated_at = excluded.updated_at
+    ''', (str(channel.id), str(last_message.id), to_epoch_ms(last_message.created_at)))
+    return sum(entry[0] for entry in activity.values())
+
 async def fetch_and_insert_channel_messages(channel, one_month_ago):
-    logger.info(f'Fetching messages from channel: {channel.name}')
+    # Resume after the last ingested message if this channel was backfilled before
+    checkpoint = await get_channel_checkpoint(channel.id)
+    after = discord.Object(id=int(checkpoint['last_message_id'])) if checkpoint else one_month_ago
+    logger.info(f'Fetching messages from channel: {channel.name} (resuming: {checkpoint is not None})')
     messages_to_insert = []
-    users_to_insert = []
+    last_message = None
+    inserted = 0
     try:
-        async for message in channel.history(after=one_month_ago, limit=None):
-            if not message.content:
-                continue
-            # Determine if message contains a link
-            is_linked = 1 if 'http' in message.content else 0
-            # Compute the initial final_score
-            final_score = compute_initial_score(message.author.id)
-            messages_to_insert.append((
-                str(message.author.id),
-                message.author.name,
-                str(channel.id),
-                message.content,
-                message.created_at,
-                is_linked,
-                final_score
-             ))
-            users_to_insert.append((
-                str(message.author.id),
-                message.author.name
-            ))
-        if messages_to_insert:
-            # Perform a bulk insert to optimize DB writes
-            with get_db_connection() as conn:
-                conn.executemany('''
-                    INSERT INTO messages (user_id, username, channel_id, content, created_at, is_linked, final_score)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', messages_to_insert)
-                conn.executemany('''
-                    INSERT OR IGNORE INTO users (id, username)
-                    VALUES (?, ?)
-                ''', users_to_insert)
-                conn.commit()  # Ensure changes are saved
-            logger.info(f'Inserted {len(messages_to_insert)} messages from channel: {channel.name}')
+        async for message in channel.history(after=after, limit=None, oldest_first=True):
+            last_message = message
+            if message.content:
+                messages_to_insert.append((
+                    str(message.id),
+                    str(message.author.id),
+                    message.author.name,
+                    str(channel.id),
+                    message.content,
+                    to_epoch_ms(message.created_at)
+                ))
+            if len(messages_to_insert) >= CHUNK_SIZE:
+                inserted += await db.run(write_chunk, channel, messages_to_insert, last_message)
+                messages_to_insert = []
+        if last_message is not None:
+            inserted += await db.run(write_chunk, channel, messages_to_insert, last_message)
+        logger.info(f'Inserted {inserted} messages from channel: {channel.name}')
     except discord.Forbidden:
         logger.warning(f'Forbidden access to channel: {channel.name}')
+    except discord.RateLimited:
+        # Let the crawler back off; the checkpoint makes the retry resume where this left off
+        raise
+    except discord.HTTPException as e:
+        if e.status == 429:
+            raise
+        logger.error(f'Error fetching messages from channel {channel.name}: {e}')
     except Exception as e:
         logger.error(f'Error fetching messages from channel {channel.name}: {e}')
-
-def compute_initial_score(user_id):
-    """Compute the initial score for a user."""
-    with get_db_connection() as conn:
-        cur = conn.execute('''
-            SELECT COUNT(*) as msg_count, MAX(created_at) as last_message
-            FROM messages
-            WHERE user_id = ? AND created_at >= datetime('now','-30 days')
-        ''', (user_id,))
-        result = cur.fetchone()
-        msg_count = result['msg_count'] if result and result['msg_count'] is not None else 0
-        last_message = result['last_message']
-        if last_message:
-            try:
-                last_message_dt = datetime.fromisoformat(last_message)
-            except Exception as e:
-                logger.error(f"Error parsing last_message for user {user_id}: {e}")
-                last_message_dt = datetime.now(timezone.utc)
-            days_since = (datetime.now(timezone.utc) - last_message_dt).days
-        else:
-            days_since = 999  # High penalty if no messages
-
-        # Build a row dictionary similar to what FlagScanner uses
-        row = {
-            'messages_past_month': msg_count,
-            'days_since_last_message': days_since,
-            'sent_messages_after_joining': False,
-            'messaged_within_30_days': False,
-            'above_100_messages': False,
-            'below_10_messages': False,
-            'never_messaged': False,
-            'no_role_assigned': False,
-            'low_interaction_high_activity': False
-        }
-
-        score = 0
-        # Base score from messages
-        for i in range(msg_count):
-            score += 5 + (i * 0.2)
-
-        # Incorporate flag contributions (flags default to False here)
-        flag_weights = {
-            "sent_messages_after_joining": 50,
-            "messaged_within_30_days": 100,
-            "above_100_messages": 150,
-            "below_10_messages": -50,
-            "never_messaged": -200,
-            "no_role_assigned": -100,
-            "low_interaction_high_activity": -150
-        }
-        for flag, weight in flag_weights.items():
-            if row.get(flag):
-                score += weight
-
-        # Time adjustment based on recency
-        if days_since <= 7:
-            for _ in range(7 - days_since):
-                score += 10
-        elif days_since > 30:
-            for _ in range(days_since - 30):
-                score -= 5
-
-        return score
+    return inserted
 
 logger.info('Running bot')
 bot.run(sensitive_vars.bot_token)  # Use bot token from sensitive variables
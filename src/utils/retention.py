@@ -0,0 +1,120 @@
+import logging
+import os
+import zlib
+from utils.timeutil import SQL_NOW_MS, days_ago_ms
+
+logger = logging.getLogger(__name__)
+
+# Messages older than this many days have their content dropped or compressed
+RETENTION_DAYS = int(os.getenv('RETENTION_DAYS', 90))
+# 'drop' blanks the content, 'compress' stores it deflate-compressed, 'off' (the default) disables the job
+RETENTION_MODE = os.getenv('RETENTION_MODE', 'off')
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', 5000))
+RETENTION_INTERVAL_HOURS = float(os.getenv('RETENTION_INTERVAL_HOURS', 24))
+# Free pages returned to the filesystem per run; 0 frees all of them
+RETENTION_VACUUM_PAGES = int(os.getenv('RETENTION_VACUUM_PAGES', 0))
+
+RETENTION_MODES = ('drop', 'compress', 'off')
+
+
+def compress_content(content):
+    # Raw deflate: most messages are a few dozen bytes, so the zlib header and checksum would eat the savings
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    return compressor.compress(content.encode('utf-8')) + compressor.flush()
+
+
+def compact_messages(conn, cutoff, mode, batch_size=RETENTION_BATCH_SIZE):
+    """
+    Drop or compress the content of the next `batch_size` messages created before `cutoff`,
+    inside the caller's transaction. Messages are visited in (created_at, id) order from
+    the cursor in retention_state, so each one is considered once per mode: the cursor
+    starts over when the mode changes, so switching to drop also blanks messages that
+    were compressed. In compress mode a message whose deflated content would not be
+    smaller keeps its text. Counts and
+    timestamps already live in user_stats and activity_daily (record_messages maintains
+    them and migration 8 backfilled them), so nothing else needs folding first. Returns
+    (messages visited, messages compacted).
+    """
+    if mode not in RETENTION_MODES:
+        raise ValueError(f"Unknown retention mode: {mode}")
+    if mode == 'off':
+        return 0, 0
+    state = conn.execute('SELECT last_created_at, last_id, mode FROM retention_state WHERE id = 1').fetchone()
+    if state and state['mode'] == mode:
+        last_created_at, last_id = state['last_created_at'], state['last_id']
+    else:
+        last_created_at, last_id = -1, -1
+    rows = conn.execute('''
+        SELECT id, content, created_at FROM messages
+        WHERE (created_at, id) > (?, ?) AND created_at < ?
+        ORDER BY created_at, id
+        LIMIT ?
+    ''', (last_created_at, last_id, cutoff, batch_size)).fetchall()
+    if not rows:
+        return 0, 0
+    updates = []
+    for row in rows:
+        content = row['content']
+        if not content:
+            continue
+        if mode == 'drop':
+            updates.append(('', row['id']))
+        elif isinstance(content, str):
+            compressed = compress_content(content)
+            if len(compressed) < len(content.encode('utf-8')):
+                updates.append((compressed, row['id']))
+    conn.executemany('UPDATE messages SET content = ? WHERE id = ?', updates)
+    conn.execute(f'''
+        INSERT INTO retention_state (id, last_created_at, last_id, mode, updated_at)
+        VALUES (1, ?, ?, ?, {SQL_NOW_MS})
+        ON CONFLICT(id) DO UPDATE SET
+            last_created_at = excluded.last_created_at,
+            last_id = excluded.last_id,
+            mode = excluded.mode,
+            updated_at = excluded.updated_at
+    ''', (rows[-1]['created_at'], rows[-1]['id'], mode))
+    return len(rows), len(updates)
+
+
+def enable_incremental_vacuum(conn):
+    """
+    Switch the database to incremental auto-vacuum. This takes a one-off full VACUUM that
+    blocks every other query while it runs and cannot run inside a transaction, so it is
+    left to an admin command rather than the retention job. Returns True if it vacuumed.
+    """
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        return False
+    logger.info("Enabling incremental auto-vacuum (one-off full VACUUM)")
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    return True
+
+
+def incremental_vacuum(conn, pages=RETENTION_VACUUM_PAGES):
+    """
+    Return up to `pages` free pages to the filesystem (all of them when 0). Does nothing
+    until enable_incremental_vacuum has run. Returns the pages freed.
+    """
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return 0
+    free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    conn.execute(f'PRAGMA incremental_vacuum({int(pages)})').fetchall()
+    return free_pages - conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+
+async def run_retention(database, days=RETENTION_DAYS, mode=RETENTION_MODE, batch_size=RETENTION_BATCH_SIZE):
+    """
+    Compact every message older than `days` days in batches of `batch_size`, one
+    transaction per batch so live ingestion keeps flowing, then vacuum the freed pages
+    if incremental auto-vacuum is enabled. Returns {compacted, freed_pages}.
+    """
+    cutoff = days_ago_ms(days)
+    compacted = 0
+    while True:
+        visited, count = await database.run(compact_messages, cutoff, mode, batch_size)
+        compacted += count
+        if visited < batch_size:
+            break
+    freed_pages = await database.run_outside_transaction(incremental_vacuum)
+    logger.info(f"Retention: compacted {compacted} messages older than {days} days ({mode}), freed {freed_pages} pages")
+    return {"compacted": compacted, "freed_pages": freed_pages}
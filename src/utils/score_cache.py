@@ -0,0 +1,123 @@
+import os
+import threading
+from collections import OrderedDict
+from flags import FLAG_NAMES
+
+# Users whose score and flags are kept in memory, least recently used evicted first
+SCORE_CACHE_SIZE = int(os.getenv('SCORE_CACHE_SIZE', 10000))
+
+
+def pack_flags(flags):
+    """Pack a flag dict into an int, one bit per flag in FLAG_NAMES order."""
+    return sum(1 << i for i, name in enumerate(FLAG_NAMES) if flags[name])
+
+
+def unpack_flags(bits):
+    return {name: bool(bits >> i & 1) for i, name in enumerate(FLAG_NAMES)}
+
+
+class ScoreEntry:
+    """A user's score and flag vector, with the flags packed into a bitmask."""
+    __slots__ = ("user_id", "score", "flag_bits")
+
+    def __init__(self, user_id, score, flags):
+        self.user_id = user_id
+        self.score = score
+        self.flag_bits = pack_flags(flags)
+
+    @property
+    def flags(self):
+        return unpack_flags(self.flag_bits)
+
+
+class ScoreCache:
+    """
+    LRU cache of ScoreEntry keyed by user ID (str). Entries are dropped when the user's
+    activity or links change (see utils.user_scores.mark_dirty_users) and refreshed when
+    their score is recomputed, so a hit is always as fresh as a recomputation.
+
+    A lookup that misses takes `generation` before computing and passes it to put(),
+    which discards the result if the user was invalidated in the meantime.
+    """
+
+    def __init__(self, max_size=SCORE_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        # Generation of each user's latest invalidation, bounded like the entries; puts
+        # started before `_floor` are discarded since their record may have been evicted
+        self._invalidated = OrderedDict()
+        self._floor = 0
+        # Invalidations arrive from the database thread
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(str(user_id))
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry.user_id)
+            self.hits += 1
+            return entry
+
+    def put(self, user_id, score, flags, generation=None):
+        """Cache and return an entry, unless the user was invalidated after `generation`."""
+        entry = ScoreEntry(str(user_id), score, flags)
+        with self._lock:
+            if generation is not None and (
+                generation < self._floor or self._invalidated.get(entry.user_id, 0) > generation
+            ):
+                return entry
+            self._store(entry)
+        return entry
+
+    def refresh(self, user_id, score, flags):
+        """Replace a cached entry with a freshly computed one; users not in the cache are left out."""
+        entry = ScoreEntry(str(user_id), score, flags)
+        with self._lock:
+            if entry.user_id in self._entries:
+                self._entries[entry.user_id] = entry
+
+    def _store(self, entry):
+        self._entries[entry.user_id] = entry
+        self._entries.move_to_end(entry.user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_ids=None):
+        """Drop the given users, or every entry when None."""
+        with self._lock:
+            self.generation += 1
+            if user_ids is None:
+                self._entries.clear()
+                self._invalidated.clear()
+                self._floor = self.generation
+                return
+            for user_id in user_ids:
+                user_id = str(user_id)
+                self._entries.pop(user_id, None)
+                self._invalidated[user_id] = self.generation
+                self._invalidated.move_to_end(user_id)
+            while len(self._invalidated) > self.max_size:
+                _, generation = self._invalidated.popitem(last=False)
+                self._floor = max(self._floor, generation)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_score_cache():
+    """Return the ScoreCache shared by the bot and the rescoring paths."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ScoreCache()
+        return _cache
@@ -1,36 +1,63 @@
 # File: src/utils/score_calculator.py
 
-# This module contains a shared score calculation function using the formula from FlagScanner._initialize_dataframe
+# This module contains the shared score calculation used by FlagScanner and populate_db.
+# calculate_score scores a single row, calculate_scores scores a whole DataFrame column-wise.
+
+FLAG_WEIGHTS = {
+    "sent_messages_after_joining": 50,
+    "messaged_within_30_days": 100,
+    "above_100_messages": 150,
+    "below_10_messages": -50,
+    "never_messaged": -200,
+    "no_role_assigned": -100,
+    "low_interaction_high_activity": -150
+}
+
+RECENT_DAYS = 7  # Bonus of 10 per day below this many days since the last message
+STALE_DAYS = 30  # Penalty of 5 per day above this many days since the last message
+
+
+def message_score(num_messages):
+    """
+    Base score from messages: message i (0-based) contributes 5 + 0.2 * i, so n messages
+    sum to 5n + 0.1n(n - 1). Works on ints and on pandas Series alike.
+    """
+    return num_messages * (49 + num_messages) / 10
+
 
 def calculate_score(row):
     """Calculate the final score for a user based on their activity and flags."""
-    score = 0
     # Base score: each message contributes increasing amount
     num_messages = int(row.get("messages_past_month", 0))
-    for i in range(num_messages):
-        score += 5 + (i * 0.2)
+    score = message_score(num_messages) if num_messages > 0 else 0
 
     # Flag contributions
-    flag_weights = {
-        "sent_messages_after_joining": 50,
-        "messaged_within_30_days": 100,
-        "above_100_messages": 150,
-        "below_10_messages": -50,
-        "never_messaged": -200,
-        "no_role_assigned": -100,
-        "low_interaction_high_activity": -150
-    }
-    for flag, weight in flag_weights.items():
+    for flag, weight in FLAG_WEIGHTS.items():
         if row.get(flag):
             score += weight
 
     # Time adjustment based on recency
     days = int(row.get("days_since_last_message", 0))
-    if days <= 7:
-        for _ in range(7 - days):
-            score += 10
-    elif days > 30:
-        for _ in range(days - 30):
-            score -= 5
+    score += 10 * max(RECENT_DAYS - days, 0) - 5 * max(days - STALE_DAYS, 0)
+
+    return score
+
+
+def calculate_scores(frame):
+    """Calculate the final score of every row of a DataFrame at once, matching calculate_score row by row."""
+    score = 0
+    if "messages_past_month" in frame:
+        num_messages = frame["messages_past_month"].fillna(0).astype(int)
+        score = message_score(num_messages.clip(lower=0))
+
+    for flag, weight in FLAG_WEIGHTS.items():
+        if flag in frame:
+            score = score + frame[flag].fillna(False).astype(bool) * weight
+
+    if "days_since_last_message" in frame:
+        days = frame["days_since_last_message"].fillna(0).astype(int)
+        score = score + 10 * (RECENT_DAYS - days).clip(lower=0) - 5 * (days - STALE_DAYS).clip(lower=0)
+    else:
+        score = score + 10 * RECENT_DAYS
 
     return score
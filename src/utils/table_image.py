@@ -0,0 +1,22 @@
+# Renders small tables (e.g. a user's score and flags) to PNG bytes.
+# Kept free of bot imports so it can run in worker processes.
+import io
+
+
+def render_table(columns, rows):
+    """Render a table with the given column labels and rows to PNG bytes."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(len(columns) * 1.5, len(rows) * 0.5))
+    ax.axis('tight')
+    ax.axis('off')
+    table = ax.table(cellText=rows, colLabels=columns, cellLoc="center", loc="center")
+    table.auto_set_font_size(False)
+    table.set_fontsize(10)
+    table.auto_set_column_width(col=list(range(len(columns))))  # Adjust column width
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", bbox_inches='tight')
+    plt.close(fig)
+    return buffer.getvalue()
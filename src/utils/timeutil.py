@@ -0,0 +1,50 @@
+import datetime
+import time
+import pytz
+
+# Timestamps are stored as integer milliseconds since the Unix epoch (UTC)
+DAY_MS = 86400000
+# Discord snowflakes count milliseconds from 2015-01-01T00:00:00Z in their top 42 bits
+DISCORD_EPOCH_MS = 1420070400000
+
+# SQL expression for the current time in epoch milliseconds, for column defaults and upserts
+SQL_NOW_MS = "CAST(ROUND((julianday('now') - 2440587.5) * 86400000) AS INTEGER)"
+
+
+def sql_to_epoch_ms(column):
+    """SQL expression converting a text timestamp column to epoch milliseconds, leaving integers alone."""
+    return (f"CASE WHEN typeof({column}) = 'text' "
+            f"THEN CAST(ROUND((julianday({column}) - 2440587.5) * 86400000) AS INTEGER) ELSE {column} END")
+
+
+def to_epoch_ms(value):
+    """Convert a datetime (naive means UTC), ISO string or epoch-ms int to epoch milliseconds."""
+    if value is None or isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=pytz.utc)
+    return round(value.timestamp() * 1000)
+
+
+def from_epoch_ms(value):
+    """Convert epoch milliseconds to an aware UTC datetime."""
+    if value is None:
+        return None
+    return datetime.datetime.fromtimestamp(value / 1000, pytz.utc)
+
+
+def now_ms():
+    return time.time_ns() // 1000000
+
+
+def days_ago_ms(days, now=None):
+    """Return the epoch milliseconds `days` days before `now` (epoch ms, defaults to the current time)."""
+    return (now_ms() if now is None else now) - days * DAY_MS
+
+
+def last_snowflake_at_ms(value):
+    """Return the largest Discord snowflake that can be created in the millisecond `value`."""
+    return ((value - DISCORD_EPOCH_MS + 1) << 22) - 1
+
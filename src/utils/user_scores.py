@@ -0,0 +1,122 @@
+import os
+from flags import compute_flags
+from utils.db import QUERY_CHUNK_SIZE
+from utils.activity_daily import day_cutoff
+from utils.timeutil import DAY_MS, now_ms
+from utils.score_cache import get_score_cache
+from utils.score_calculator import calculate_score
+
+# Dirty users rescored per transaction, and how often the scheduler drains the queue
+RESCORE_BATCH_SIZE = int(os.getenv('RESCORE_BATCH_SIZE', 500))
+RESCORE_INTERVAL_SECONDS = float(os.getenv('RESCORE_INTERVAL_SECONDS', 30))
+# How often every user is rescored so the recency bonus/penalty follows the clock
+DECAY_INTERVAL_HOURS = float(os.getenv('DECAY_INTERVAL_HOURS', 24))
+
+
+def stats_from_row(row):
+    """Build the activity stats used by compute_flags from a user_stats row."""
+    return {
+        "total_count": row['message_count'],
+        "since_join_count": row['message_count'],
+        "recent_count": row['messages_past_month'],
+        "first_message": row['first_message'],
+        "last_message": row['last_message']
+    }
+
+
+def score_stats_row(row, now=None):
+    """Score a user from their user_stats row alone, without touching `messages`."""
+    now = now or now_ms()
+    stats = stats_from_row(row)
+    last_message = row['last_message']
+    user_row = {
+        "messages_past_month": row['messages_past_month'],
+        "days_since_last_message": (now - last_message) // DAY_MS if last_message else 0,
+        **compute_flags(stats)
+    }
+    return calculate_score(user_row)
+
+
+def rescore_users(conn, user_ids, now=None):
+    """
+    Recompute and store the score of the given users from user_stats, inside the caller's
+    transaction. messages_past_month is refreshed from the last 30 daily buckets first, so
+    messages ageing out of the window are accounted for. Cached entries of these users
+    are refreshed with the new score and flags. Callers run notify_scores_changed once
+    the transaction commits, so listeners never rebuild from the uncommitted state.
+    """
+    user_ids = list(dict.fromkeys(str(user_id) for user_id in user_ids))
+    month_start = day_cutoff(30, now)
+    cache = get_score_cache()
+    scores = []
+    for start in range(0, len(user_ids), QUERY_CHUNK_SIZE):
+        chunk = user_ids[start:start + QUERY_CHUNK_SIZE]
+        placeholders = ', '.join('?' for _ in chunk)
+        conn.execute(f'''
+            UPDATE user_stats SET messages_past_month = (
+                SELECT COALESCE(SUM(a.message_count), 0) FROM activity_daily a
+                WHERE a.user_id = user_stats.user_id AND a.day >= ?
+            )
+            WHERE user_id IN ({placeholders})
+        ''', (month_start, *chunk))
+        rows = conn.execute(f'''
+            SELECT user_id, message_count, messages_past_month, first_message, last_message
+            FROM user_stats
+            WHERE user_id IN ({placeholders})
+        ''', chunk).fetchall()
+        for row in rows:
+            score = score_stats_row(row, now)
+            scores.append((score, row['user_id']))
+            cache.refresh(row['user_id'], score, compute_flags(stats_from_row(row)))
+    conn.executemany('UPDATE user_stats SET score = ? WHERE user_id = ?', scores)
+    return dict((user_id, score) for score, user_id in scores)
+
+
+def score_user(conn, user_id, now=None):
+    """
+    Rescore one user through rescore_users and return (score, flags), inside the caller's
+    transaction. Users without messages have no user_stats row; they are scored from
+    empty stats and nothing is written for them.
+    """
+    user_id = str(user_id)
+    scores = rescore_users(conn, [user_id], now)
+    row = conn.execute('''
+        SELECT message_count, messages_past_month, first_message, last_message
+        FROM user_stats
+        WHERE user_id = ?
+    ''', (user_id,)).fetchone()
+    if row is None:
+        row = {"message_count": 0, "messages_past_month": 0, "first_message": None, "last_message": None}
+        return score_stats_row(row, now), compute_flags(stats_from_row(row))
+    return scores[user_id], compute_flags(stats_from_row(row))
+
+
+def mark_dirty_users(conn, user_ids, now=None):
+    """Queue users for rescoring by the scheduler and drop their cached score, inside the caller's transaction."""
+    now = now or now_ms()
+    user_ids = [str(user_id) for user_id in user_ids]
+    get_score_cache().invalidate(user_ids)
+    conn.executemany('''
+        INSERT INTO dirty_users (user_id, marked_at) VALUES (?, ?)
+        ON CONFLICT(user_id) DO NOTHING
+    ''', ((user_id, now) for user_id in user_ids))
+
+
+def rescore_dirty_users(conn, limit=RESCORE_BATCH_SIZE, now=None):
+    """Rescore up to `limit` of the longest-waiting dirty users and clear their mark. Returns {user_id: score}."""
+    user_ids = [row[0] for row in conn.execute('''
+        DELETE FROM dirty_users
+        WHERE user_id IN (SELECT user_id FROM dirty_users ORDER BY marked_at LIMIT ?)
+        RETURNING user_id
+    ''', (limit,))]
+    if not user_ids:
+        return {}
+    return rescore_users(conn, user_ids, now)
+
+
+def rescore_user_page(conn, after_user_id, limit=RESCORE_BATCH_SIZE, now=None):
+    """Rescore the next `limit` users in user_stats after `after_user_id`. Returns {user_id: score}."""
+    user_ids = [row[0] for row in conn.execute('''
+        SELECT user_id FROM user_stats WHERE user_id > ? ORDER BY user_id LIMIT ?
+    ''', (after_user_id, limit))]
+    return rescore_users(conn, user_ids, now) if user_ids else {}
@@ -1,16 +1,30 @@
-from flask import Flask, render_template_string, request, g
-import sqlite3
-import pandas as pd
+"""
+Async web dashboard for the leaderboard, built on aiohttp (already required by discord.py).
+
+bot.py serves it on the bot's own event loop through start_web_server/stop_web_server.
+It can also run on its own with `python src/webapp.py`, or with several worker
+processes behind gunicorn:
+    gunicorn 'webapp:create_app()' --worker-class aiohttp.GunicornWebWorker --workers 4 --bind :8000
+"""
+import asyncio
+import html
+import json
+import logging
 import os
-from utils.db import Database  # Use the Database class from utils/db.py
+import time
+from string import Template
+from aiohttp import web
+from utils.leaderboard import get_leaderboard_service
 
-app = Flask(__name__)
+logger = logging.getLogger(__name__)
 
-# Create a global Database instance
-db_instance = Database()
+# Requests handled at once; further requests wait up to WEB_QUEUE_TIMEOUT seconds, then get a 503
+WEB_MAX_CONCURRENCY = int(os.getenv('WEB_MAX_CONCURRENCY', 32))
+WEB_QUEUE_TIMEOUT = float(os.getenv('WEB_QUEUE_TIMEOUT', 5))
+WEB_PORT = int(os.getenv('WEB_PORT', 8000))
 
 # HTML template for leaderboard
-template = """
+template = Template("""
 <!DOCTYPE html>
 <html lang=\"en\">
 <head>
@@ -69,7 +83,7 @@ template = """
             <h2 class=\"highlight\">Top Performers</h2>
             <form class=\"input-form\" method=\"get\" action=\"/\">
                 <label for=\"limit\">Number of users to show:</label>
-                <input type=\"number\" id=\"limit\" name=\"limit\" min=\"1\" value=\"{{ limit }}\">
+                <input type=\"number\" id=\"limit\" name=\"limit\" min=\"1\" value=\"$limit\">
                 <button type=\"submit\">Update</button>
             </form>
             <table class=\"stats-table\">
@@ -81,76 +95,192 @@ template = """
                     </tr>
                 </thead>
                 <tbody>
-                    {% for index, row in data.iterrows() %}
-                    <tr>
-                        <td>{{ index + 1 }}</td>
-                        <td>{{ row['username'] }}</td>
-                        <td>{{ row['score'] }}</td>
-                    </tr>
-                    {% endfor %}
+$rows
                 </tbody>
             </table>
         </div>
     </div>
 </body>
 </html>
-"""
+""")
+
+row_template = Template("""
+                    <tr>
+                        <td>$rank</td>
+                        <td>$username</td>
+                        <td>$score</td>
+                    </tr>""")
+
+def format_table(entries):
+    """Render (user_id, username, score) entries as a right-aligned plain text table."""
+    rows = [("username", "score")] + [(str(username), str(score)) for _, username, score in entries]
+    widths = [max(len(row[column]) for row in rows) for column in range(2)]
+    return "\n".join(" ".join(value.rjust(width) for value, width in zip(row, widths)) for row in rows)
+
+def render_index(entries, limit):
+    rows = "".join(
+        row_template.substitute(rank=rank, username=html.escape(str(username)), score=score)
+        for rank, (_, username, score) in enumerate(entries, start=1)
+    )
+    return template.substitute(limit=limit, rows=rows)
+
+def get_int(request, name, default=None):
+    """Read an integer query parameter, falling back to `default` when missing or malformed."""
+    try:
+        return int(request.query[name])
+    except (KeyError, ValueError):
+        return default
+
+def conditional_response(request, body, ranking, limit, content_type):
+    """Wrap a rendered ranking with ETag/Last-Modified and answer 304 when the client is up to date."""
+    etag = f"{ranking.etag}-{limit}"
+    if request.if_none_match:
+        not_modified = any(tag.value == etag for tag in request.if_none_match)
+    else:
+        not_modified = request.if_modified_since is not None and ranking.last_modified <= request.if_modified_since
+    response = web.Response(status=304) if not_modified else web.Response(text=body, content_type=content_type)
+    response.etag = etag
+    response.last_modified = ranking.last_modified
+    return response
+
+async def get_top(limit):
+    # A ranking rebuild queries sqlite, so keep it off the event loop
+    return await asyncio.to_thread(get_leaderboard_service().top, limit)
 
 # Frontend route to display leaderboard
-@app.route('/')
-def index():
-    limit = request.args.get('limit', default=10, type=int)
-    conn = db_instance.get_db_connection()
+async def index(request):
+    limit = get_int(request, 'limit', 10)
     try:
-        cur = conn.execute(f"""
-            SELECT u.username, MAX(m.final_score) as score
-            FROM messages m
-            JOIN users u ON m.user_id = u.id
-            GROUP BY u.username
-            ORDER BY score DESC
-            LIMIT {limit}
-        """)
-        entries = cur.fetchall()
+        entries, ranking = await get_top(limit)
     except Exception as e:
-        return f"Database error: {e}", 500
-    finally:
-        conn.close()
-    
-    # Convert sqlite3.Row objects to a list of dicts and then to a DataFrame
-    data_list = [dict(row) for row in entries]
-    df = pd.DataFrame(data_list)
-    if df.empty:
-        # Create empty columns if no data returned
-        df = pd.DataFrame(columns=['username', 'score'])
-    return render_template_string(template, data=df, limit=limit)
-
-@app.route('/leaderboard')
-def leaderboard():
-    limit = request.args.get('limit', default=10, type=int)
-    conn = db_instance.get_db_connection()
+        return web.Response(text=f"Database error: {e}", status=500)
+    return conditional_response(request, render_index(entries, limit), ranking, limit, 'text/html')
+
+async def leaderboard(request):
+    limit = get_int(request, 'limit', 10)
     try:
-        cur = conn.execute(f"""
-            SELECT u.username, MAX(m.final_score) as score
-            FROM messages m
-            JOIN users u ON m.user_id = u.id
-            GROUP BY u.username
-            ORDER BY score DESC
-            LIMIT {limit}
-        """)
-        entries = cur.fetchall()
+        entries, ranking = await get_top(limit)
     except Exception as e:
-        return f"Database error: {e}", 500
+        return web.Response(text=f"Database error: {e}", status=500)
+    return conditional_response(request, format_table(entries), ranking, limit, 'text/plain')
+
+async def api_leaderboard(request):
+    """JSON leaderboard with keyset pagination: pass the returned next_cursor as `cursor` to get the next page."""
+    try:
+        page = await asyncio.to_thread(
+            get_leaderboard_service().page,
+            limit=get_int(request, 'limit', 50),
+            cursor=request.query.get('cursor'),
+            linked_only=request.query.get('linked', 'false').lower() in ('1', 'true', 'yes'),
+            active_days=get_int(request, 'active_days'),
+            user_id=request.query.get('user_id')
+        )
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+    except Exception as e:
+        return json_response({"error": f"Database error: {e}"}, status=500)
+    return json_response(page)
+
+async def metrics(request):
+    """Per-route request counts and timings since startup."""
+    return json_response(request.app[METRICS].snapshot())
+
+def json_response(data, status=200):
+    return web.json_response(data, status=status, dumps=lambda value: json.dumps(value, separators=(',', ':')))
+
+
+class RequestMetrics:
+    """Request counts and timings per route, plus the number of requests in flight."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.routes = {}
+
+    def record(self, route, status, elapsed):
+        stats = self.routes.setdefault(route, {"count": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+        stats["count"] += 1
+        stats["errors"] += status >= 500
+        stats["total_seconds"] += elapsed
+        stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+
+    def snapshot(self):
+        return {
+            "in_flight": self.in_flight,
+            "routes": {
+                route: {**stats, "avg_seconds": stats["total_seconds"] / stats["count"]}
+                for route, stats in self.routes.items()
+            }
+        }
+
+
+METRICS = web.AppKey("metrics", RequestMetrics)
+LIMITER = web.AppKey("limiter", asyncio.Semaphore)
+
+@web.middleware
+async def timing_middleware(request, handler):
+    metrics = request.app[METRICS]
+    route = request.match_info.route.resource.canonical if request.match_info.route.resource else 'unmatched'
+    start = time.perf_counter()
+    status = 500
+    metrics.in_flight += 1
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        metrics.in_flight -= 1
+        elapsed = time.perf_counter() - start
+        metrics.record(route, status, elapsed)
+        logger.debug(f"{request.method} {request.path_qs} {status} in {elapsed * 1000:.1f}ms")
+
+@web.middleware
+async def concurrency_middleware(request, handler):
+    limiter = request.app[LIMITER]
+    try:
+        await asyncio.wait_for(limiter.acquire(), WEB_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return web.Response(text="Server busy, try again later.", status=503, headers={"Retry-After": "1"})
+    try:
+        return await handler(request)
     finally:
-        conn.close()
-    
-    # Convert sqlite3.Row objects to a list of dicts and then to a DataFrame
-    data_list = [dict(row) for row in entries]
-    df = pd.DataFrame(data_list)
-    if df.empty:
-        # Create empty columns if no data returned
-        df = pd.DataFrame(columns=['username', 'score'])
-    return df.to_string(index=False)
+        limiter.release()
+
+async def on_startup(app):
+    # Build the ranking once so the first request doesn't pay for it
+    await asyncio.to_thread(get_leaderboard_service().get_ranking)
+    logger.info("Web dashboard started")
+
+async def on_cleanup(app):
+    logger.info(f"Web dashboard stopped, request metrics: {app[METRICS].snapshot()}")
+
+def create_app(max_concurrency=WEB_MAX_CONCURRENCY):
+    app = web.Application(middlewares=[timing_middleware, concurrency_middleware])
+    app[METRICS] = RequestMetrics()
+    app[LIMITER] = asyncio.Semaphore(max_concurrency)
+    app.router.add_get('/', index)
+    app.router.add_get('/leaderboard', leaderboard)
+    app.router.add_get('/api/leaderboard', api_leaderboard)
+    app.router.add_get('/metrics', metrics)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+async def start_web_server(port=WEB_PORT, host='localhost'):
+    """Serve the dashboard on the running event loop and return the runner to stop it with."""
+    runner = web.AppRunner(create_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Web dashboard listening on http://{host}:{port}")
+    return runner
+
+async def stop_web_server(runner):
+    """Stop accepting requests, let in-flight ones finish and run the cleanup hooks."""
+    await runner.cleanup()
 
 if __name__ == '__main__':
-    # Run the Flask app on port 8000
-    app.run(port=8000, debug=True, use_reloader=False)
+    logging.basicConfig(level=logging.INFO)
+    # Run the dashboard on port 8000
+    web.run_app(create_app(), port=WEB_PORT)
@@ -0,0 +1,154 @@
+import pytest
+from utils.db import Database
+from utils.get_linked_users import FINGERPRINT_BYTES, LinkedUsers, open_local_file
+from utils.ingest import record_messages
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = Database(str(tmp_path / 'messages.db'))
+    yield database
+    database.close()
+
+
+@pytest.fixture
+def link_file(tmp_path):
+    return tmp_path / 'links.aof'
+
+
+@pytest.fixture
+def linked_users(monkeypatch, database):
+    monkeypatch.setenv('SFTP_PORT', '22')
+    return LinkedUsers(opener=open_local_file, database=database)
+
+
+def sync(linked_users, link_file):
+    return linked_users.sync_links([{"name": "server", "path": str(link_file)}])
+
+
+def stored_links(database):
+    rows = database.conn.execute('SELECT discord_id, minecraft_uuid FROM links WHERE source = ?', ('server',))
+    return dict(rows.fetchall())
+
+
+def link_state(database):
+    return database.conn.execute('SELECT byte_offset FROM link_sources WHERE source = ?', ('server',)).fetchone()[0]
+
+
+def is_linked(database, user_id):
+    return database.conn.execute('SELECT is_linked FROM user_stats WHERE user_id = ?', (user_id,)).fetchone()[0]
+
+
+def add_message(database, message_id, user_id):
+    with database.conn as conn:
+        record_messages(conn, [(message_id, user_id, f'user{user_id}', 'channel', 'hello', 1700000000000)])
+
+
+def test_append_is_read_as_tail(linked_users, database, link_file):
+    link_file.write_bytes(b'1 uuid-1\n2 uuid-2\n')
+    sync(linked_users, link_file)
+    offset = link_state(database)
+
+    with open(link_file, 'ab') as file:
+        file.write(b'3 uuid-3\n2 uuid-2b\n')
+    source = {"name": "server", "path": str(link_file)}
+    state = dict(database.conn.execute('SELECT * FROM link_sources').fetchone())
+    entries, full_reload, _ = linked_users.fetch_source(source, state)
+    assert not full_reload
+    assert entries == {'3': 'uuid-3', '2': 'uuid-2b'}
+
+    summary = sync(linked_users, link_file)
+    assert (summary['added'], summary['updated'], summary['removed']) == (1, 1, 0)
+    assert stored_links(database) == {'1': 'uuid-1', '2': 'uuid-2b', '3': 'uuid-3'}
+    assert link_state(database) == offset + len(b'3 uuid-3\n2 uuid-2b\n')
+
+
+def test_trailing_partial_line_waits_for_its_newline(linked_users, database, link_file):
+    link_file.write_bytes(b'1 uuid-1\n2 uu')
+    sync(linked_users, link_file)
+    assert stored_links(database) == {'1': 'uuid-1'}
+    assert link_state(database) == len(b'1 uuid-1\n')
+
+    with open(link_file, 'ab') as file:
+        file.write(b'id-2\n')
+    summary = sync(linked_users, link_file)
+    assert summary['added'] == 1
+    assert stored_links(database) == {'1': 'uuid-1', '2': 'uuid-2'}
+
+
+def test_truncated_file_is_reloaded(linked_users, database, link_file):
+    link_file.write_bytes(b'1 uuid-1\n2 uuid-2\n')
+    sync(linked_users, link_file)
+
+    link_file.write_bytes(b'3 uuid-3\n')
+    summary = sync(linked_users, link_file)
+    assert summary['removed'] == 2
+    assert stored_links(database) == {'3': 'uuid-3'}
+
+
+def test_rewrite_with_same_head_is_reloaded(linked_users, database, link_file):
+    head = b''.join(b'%d uuid-%d\n' % (user, user) for user in range(1, 1000))
+    assert len(head) > FINGERPRINT_BYTES
+    link_file.write_bytes(head + b'5000 uuid-old\n')
+    sync(linked_users, link_file)
+
+    # Same size, same first FINGERPRINT_BYTES, different last line
+    link_file.write_bytes(head + b'6000 uuid-new\n')
+    summary = sync(linked_users, link_file)
+    links = stored_links(database)
+    assert '5000' not in links
+    assert links['6000'] == 'uuid-new'
+    assert summary['removed'] == 1
+
+
+def test_full_reload_removes_missing_links(linked_users, database, link_file):
+    link_file.write_bytes(b'1 uuid-1\n2 uuid-2\n')
+    sync(linked_users, link_file)
+    database.conn.execute('DELETE FROM link_sources')
+    database.conn.commit()
+
+    link_file.write_bytes(b'1 uuid-1\n')
+    summary = sync(linked_users, link_file)
+    assert (summary['added'], summary['updated'], summary['removed']) == (0, 0, 1)
+    assert summary['changed_users'] == {'2'}
+    assert stored_links(database) == {'1': 'uuid-1'}
+
+
+def test_user_linked_before_first_message_is_linked(linked_users, database, link_file):
+    link_file.write_bytes(b'111 uuid-1\n')
+    sync(linked_users, link_file)
+    add_message(database, '1', '111')
+    add_message(database, '2', '222')
+    sync(linked_users, link_file)
+    assert is_linked(database, '111') == 1
+    assert is_linked(database, '222') == 0
+
+
+def test_link_changes_update_linked_status(linked_users, database, link_file):
+    add_message(database, '1', '111')
+    link_file.write_bytes(b'222 uuid-2\n')
+    sync(linked_users, link_file)
+    assert is_linked(database, '111') == 0
+
+    with open(link_file, 'ab') as file:
+        file.write(b'111 uuid-1\n')
+    summary = sync(linked_users, link_file)
+    assert is_linked(database, '111') == 1
+    assert '111' in summary['changed_users']
+
+    link_file.write_bytes(b'222 uuid-2\n')
+    sync(linked_users, link_file)
+    assert is_linked(database, '111') == 0
+
+
+def test_full_sync_clears_stale_linked_flags(linked_users, database, link_file):
+    add_message(database, '1', '111')
+    database.conn.execute('UPDATE user_stats SET is_linked = 1')
+    database.conn.commit()
+
+    link_file.write_bytes(b'222 uuid-2\n')
+    summary = sync(linked_users, link_file)
+    assert is_linked(database, '111') == 0
+    assert '111' in summary['changed_users']
+    queued = database.conn.execute('SELECT user_id FROM dirty_users').fetchall()
+    assert ('111',) in [tuple(row) for row in queued]
@@ -0,0 +1,86 @@
+import itertools
+import pandas as pd
+import pytest
+from utils.score_calculator import FLAG_WEIGHTS, calculate_score, calculate_scores
+
+FLAGS = list(FLAG_WEIGHTS)
+MESSAGE_COUNTS = [*range(0, 301), 1000, 5000, 100000]
+DAYS = range(-2, 1000)
+
+
+def reference_score(row):
+    """The original loop implementation, frozen as the golden reference."""
+    score = 0
+    num_messages = int(row.get("messages_past_month", 0))
+    for i in range(num_messages):
+        score += 5 + (i * 0.2)
+
+    flag_weights = {
+        "sent_messages_after_joining": 50,
+        "messaged_within_30_days": 100,
+        "above_100_messages": 150,
+        "below_10_messages": -50,
+        "never_messaged": -200,
+        "no_role_assigned": -100,
+        "low_interaction_high_activity": -150
+    }
+    for flag, weight in flag_weights.items():
+        if row.get(flag):
+            score += weight
+
+    days = int(row.get("days_since_last_message", 0))
+    if days <= 7:
+        for _ in range(7 - days):
+            score += 10
+    elif days > 30:
+        for _ in range(days - 30):
+            score -= 5
+
+    return score
+
+
+def flag_combinations():
+    for values in itertools.product([False, True], repeat=len(FLAGS)):
+        yield dict(zip(FLAGS, values))
+
+
+@pytest.mark.parametrize("messages", MESSAGE_COUNTS)
+def test_message_counts(messages):
+    row = {"messages_past_month": messages, "days_since_last_message": 10}
+    assert calculate_score(row) == pytest.approx(reference_score(row), abs=1e-9, rel=1e-12)
+
+
+def test_days_since_last_message():
+    for days in DAYS:
+        row = {"messages_past_month": 3, "days_since_last_message": days}
+        assert calculate_score(row) == pytest.approx(reference_score(row), abs=1e-9)
+
+
+def test_flag_combinations():
+    for flags in flag_combinations():
+        row = {"messages_past_month": 12, "days_since_last_message": 40, **flags}
+        assert calculate_score(row) == pytest.approx(reference_score(row), abs=1e-9)
+
+
+def test_missing_columns_use_defaults():
+    assert calculate_score({}) == pytest.approx(reference_score({}))
+
+
+def test_calculate_scores_matches_rows():
+    rows = [
+        {"messages_past_month": messages, "days_since_last_message": days, **flags}
+        for messages, days, flags in zip(
+            itertools.cycle(MESSAGE_COUNTS),
+            itertools.islice(itertools.cycle(DAYS), 3000),
+            itertools.cycle(flag_combinations())
+        )
+    ]
+    frame = pd.DataFrame(rows, columns=["messages_past_month", "days_since_last_message", *FLAGS])
+    expected = [reference_score(row) for row in rows]
+    assert calculate_scores(frame).tolist() == pytest.approx(expected, abs=1e-9, rel=1e-12)
+
+
+def test_calculate_scores_without_days_column():
+    frame = pd.DataFrame([{"messages_past_month": 5, "never_messaged": True}])
+    row = frame.iloc[0].to_dict()
+    assert calculate_scores(frame).iloc[0] == pytest.approx(reference_score(row))